@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# times rendering a mail body with a large changelog against the way it used to be rendered
+# usage: python benchmarks/benchmarkMailRendering.py [largest body in MB]
+import os
+import sys
+import re
+import time
+
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], '..'))
+import releaseIpa
+
+BUG_URLS = {
+    '[A-Z]{3}-\\d+': 'http://jira_addr/browse/{BUG_CODE}',
+    '\\d{7,}': 'http://mantis_addr/view.php?id={BUG_CODE}',
+    'GH\\d+': 'https://github.com/NoobRocks/releaseIpa/issues/{BUG_CODE}',
+    'RDR-[a-z]+\\d+': 'http://radar_addr/{BUG_CODE}',
+}
+
+def generateBody(size):
+    lines = []
+    length = 0
+    index = 0
+    templates = [u'<li>修正#NRS-%d 啟動時崩潰</li>\n', u'<li>修正#%07d</li>\n', u'<li>improve scrolling, see #GH%d</li>\n',
+                 u'<li>no bug code in this line %d</li>\n', u'<li>#RDR-abc%d reported twice</li>\n']
+    while length < size:
+        line = templates[index % len(templates)] % index
+        lines.append(line)
+        length += len(line)
+        index += 1
+    return u'<html><body>{FRIENDLY_APP_NAME} v{APP_VERSION}<br>\n{DOWNLOAD_LINKS}<ol>\n%s</ol></body></html>' % ''.join(lines)
+    
+def legacyRender(body, keywordDict, bugURLMap, links):
+    # how the mail was rendered before the template and the bug patterns were compiled
+    HTMLListItems = ''
+    for link in links:
+        HTMLListItems = HTMLListItems + '<li><a href="%s">%s</a></li>\n' % (link, link)
+    keywordDict = dict(keywordDict, DOWNLOAD_LINKS = '<ul>%s</ul>' % HTMLListItems)
+    body = body.format(**keywordDict)
+    bugURLs = bugURLMap.items()
+    groupPrefix = 'group'
+    bugURLPattern = '|'.join(['#(?P<%s>%s)' % (groupPrefix + str(index), bugURL[0]) for index, bugURL in enumerate(bugURLs)])
+    
+    def keyOfValidValue(dictionary):
+        for key in dictionary:
+            if dictionary[key]:
+                return key
+        return None
+        
+    def getBugURL(match):
+        groupKey = keyOfValidValue(match.groupdict())
+        URL = bugURLs[int(groupKey[len(groupPrefix):])][1].format(**{'BUG_CODE': match.group(groupKey)})
+        return '<a href="%s">%s</a>' % (URL, match.group(groupKey))
+    return re.sub(bugURLPattern, getBugURL, body)
+    
+def currentRender(body, keywordDict, bugURLMap, links):
+    keywordDict = dict(keywordDict, DOWNLOAD_LINKS = releaseIpa.generateHTMLHyperlinkListItems(links, {}))
+    body = releaseIpa.compileMailTemplate(body).render(keywordDict)
+    return releaseIpa.compileBugCodeLinkifier(bugURLMap).linkify(body)
+    
+def measure(render, body, keywordDict, links):
+    startTime = time.time()
+    result = render(body, keywordDict, BUG_URLS, links)
+    return time.time() - startTime, result
+    
+def main():
+    largestSize = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    keywordDict = {'FRIENDLY_APP_NAME': u'應用', 'APP_VERSION': '1.0'}
+    size = 0.5
+    print '%10s %8s %12s %12s %8s' % ('body (MB)', 'links', 'legacy (s)', 'current (s)', 'MB/s')
+    while size <= largestSize:
+        body = generateBody(int(size * (1 << 20)))
+        links = ['http://host/app_%d.ipa' % index for index in xrange(int(size * 1000))]
+        legacyTime, legacyResult = measure(legacyRender, body, keywordDict, links)
+        currentTime, currentResult = measure(currentRender, body, keywordDict, links)
+        if legacyResult != currentResult:
+            print 'the rendered bodies differ at %.1f MB' % size
+            sys.exit(1)
+        print '%10.1f %8d %12.3f %12.3f %8.1f' % (size, len(links), legacyTime, currentTime, size / max(currentTime, 0.001))
+        size *= 2
+        
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+# local stand-ins for every service a release talks to, so that releases can be timed and checked without the network
+# usage: python benchmarks/standIns.py serve [bytes per second] [latency in seconds]
+#            starts an FTP server, a Google Drive emulator and an SMTP sink, prints their ports as JSON
+#            and serves until its standard input is closed
+#        python benchmarks/standIns.py xcodebuild|svn|svnversion [arguments]
+#            stands in for the tool; BENCHMARK_XCODEBUILD_DELAY, BENCHMARK_SVN_DELAY and BENCHMARK_IPA_SIZE
+#            set how long the tools take and how large the ipas are, BENCHMARK_XCODEBUILD_TARGETS the targets of the scheme
+import os
+import sys
+import re
+import json
+import time
+import datetime
+import hashlib
+import threading
+import uuid
+import socket
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import smtpd
+import asyncore
+import tempfile
+
+def writeFakeTools(binFolder):
+    # scripts named after the tools, to be put in front of PATH
+    if not os.path.isdir(binFolder):
+        os.makedirs(binFolder)
+    for toolName in ['xcodebuild', 'svn', 'svnversion']:
+        toolPath = os.path.join(binFolder, toolName)
+        with open(toolPath, 'w') as toolFile:
+            toolFile.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, os.path.abspath(__file__), toolName))
+        os.chmod(toolPath, 0755)
+
+def runFakeXcodebuild(arguments):
+    time.sleep(float(os.environ.get('BENCHMARK_XCODEBUILD_DELAY', '0')))
+    options = dict(zip(arguments, arguments[1:]))
+    if '-showBuildSettings' in arguments:
+        # BENCHMARK_XCODEBUILD_TARGETS names the targets of the scheme that have an Info.plist
+        for target in os.environ.get('BENCHMARK_XCODEBUILD_TARGETS', 'App').split(','):
+            print 'Build settings for action build and target %s:' % target
+            print '    INFOPLIST_FILE = %s/Info.plist\n' % target
+    elif '-exportArchive' in arguments:
+        exportPath = options['-exportPath']
+        if not os.path.isdir(exportPath):
+            os.makedirs(exportPath)
+        # random content, so that no ipa is taken for one uploaded before
+        size = int(os.environ.get('BENCHMARK_IPA_SIZE', '1048576'))
+        with open(os.path.join(exportPath, 'App.ipa'), 'wb') as ipaFile:
+            while size > 0:
+                ipaFile.write(os.urandom(min(size, 1 << 20)))
+                size -= 1 << 20
+    elif 'archive' in arguments:
+        archivePath = options['-archivePath']
+        if not os.path.isdir(archivePath):
+            os.makedirs(archivePath)
+        with open(os.path.join(archivePath, 'Info.plist'), 'w') as plistFile:
+            plistFile.write('<plist version="1.0"><dict/></plist>\n')
+    return 0
+
+def runFakeSvn(arguments):
+    time.sleep(float(os.environ.get('BENCHMARK_SVN_DELAY', '0')))
+    revision = int(os.environ.get('BENCHMARK_SVN_REVISION', '1000'))
+    command = arguments[0] if arguments else ''
+    if 'info' == command:
+        print '<?xml version="1.0"?><info><entry kind="dir" path="." revision="%d"><url>file:///repository</url></entry></info>' % revision
+    elif 'status' == command:
+        # the Info.plist is the only change, as it is after the build number is increased
+        entries = ['<entry path="project/project-Info.plist"><wc-status props="none" item="modified" revision="%d"></wc-status></entry>' % revision]
+        if '-u' in arguments:
+            entries.append('<against revision="%d"/>' % revision)
+        print '<?xml version="1.0"?><status><target path=".">%s</target></status>' % ''.join(entries)
+    elif 'log' == command:
+        options = dict(zip(arguments, arguments[1:]))
+        first, last = [int(number) for number in options.get('-r', '%d:1' % revision).split(':')]
+        numbers = xrange(min(first, revision), last - 1, -1) if first >= last else xrange(first, min(last, revision) + 1)
+        entries = ['<logentry revision="%d"><author>benchmark</author><date>2000-01-01T00:00:00.000000Z</date><msg>fix #NRS-%d and #%07d</msg></logentry>' % (number, number, number)
+                   for number in numbers]
+        print '<?xml version="1.0"?><log>%s</log>' % ''.join(entries[:int(options.get('--limit', len(entries)))])
+    return 0
+
+def runFakeSvnversion(arguments):
+    print '1:%s' % os.environ.get('BENCHMARK_SVN_REVISION', '1000')
+    return 0
+
+def startFTPServer(rate, homeFolder = None, dropsAfter = 0, commands = None):
+    # dropsAfter cuts off the first transfer of every file after that many bytes, like a flaky link does;
+    # the commands the server is sent are appended to commands
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, DTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.log import config_logging
+    import logging
+
+    # every command would be logged otherwise
+    config_logging(level = logging.WARNING)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('user', 'password', homeFolder or tempfile.mkdtemp(prefix = 'benchmarkFTP'), perm = 'elradfmwMT')
+    class BenchmarkFTPHandler(FTPHandler):
+        def pre_process_command(self, line, cmd, arg):
+            if commands is not None:
+                commands.append((cmd, arg))
+            FTPHandler.pre_process_command(self, line, cmd, arg)
+    BenchmarkFTPHandler.authorizer = authorizer
+    droppedFiles = set()
+    baseDTPHandler = ThrottledDTPHandler if rate else DTPHandler
+    class BenchmarkDTPHandler(baseDTPHandler):
+        read_limit = rate
+        write_limit = rate
+
+        def handle_read(self):
+            baseDTPHandler.handle_read(self)
+            if dropsAfter and self.receive and not self._closed and self.tot_bytes_received >= dropsAfter and self.file_obj.name not in droppedFiles:
+                droppedFiles.add(self.file_obj.name)
+                self._resp = ('426 Connection dropped by the stand-in.', logging.info)
+                self.close()
+
+        handle_read_event = handle_read
+    BenchmarkFTPHandler.dtp_handler = BenchmarkDTPHandler
+    server = ThreadedFTPServer(('127.0.0.1', 0), BenchmarkFTPHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class DriveEmulator(object):
+    # the part of the Drive v2 API that the uploader uses, kept in memory
+    folderMimeType = 'application/vnd.google-apps.folder'
+
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {'root': {'id': 'root', 'title': 'root', 'mimeType': DriveEmulator.folderMimeType, 'parents': []}}
+        self.sessions = {}
+        self.baseURL = None
+        # the bytes of file data received, which tells how much a resumed upload has sent again
+        self.receivedBytes = 0
+
+    def generateDiscoveryDocument(self):
+        fileIDParameter = {'fileId': {'type': 'string', 'required': True, 'location': 'path'}}
+        return {
+            'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'drive:v2', 'name': 'drive', 'version': 'v2',
+            'protocol': 'rest', 'rootUrl': self.baseURL, 'servicePath': 'drive/v2/', 'baseUrl': self.baseURL + 'drive/v2/',
+            'batchPath': 'batch/drive/v2',
+            'parameters': {'fields': {'type': 'string', 'location': 'query'}, 'alt': {'type': 'string', 'default': 'json', 'location': 'query'}},
+            'schemas': {'File': {'id': 'File', 'type': 'object'}, 'FileList': {'id': 'FileList', 'type': 'object'},
+                        'Permission': {'id': 'Permission', 'type': 'object'}},
+            'resources': {
+                'files': {'methods': {
+                    'get': {'id': 'drive.files.get', 'path': 'files/{fileId}', 'httpMethod': 'GET', 'parameters': fileIDParameter,
+                            'parameterOrder': ['fileId'], 'response': {'$ref': 'File'}},
+                    'list': {'id': 'drive.files.list', 'path': 'files', 'httpMethod': 'GET', 'response': {'$ref': 'FileList'},
+                             'parameters': {'q': {'type': 'string', 'location': 'query'}, 'maxResults': {'type': 'integer', 'location': 'query'},
+                                            'pageToken': {'type': 'string', 'location': 'query'}}},
+                    'insert': {'id': 'drive.files.insert', 'path': 'files', 'httpMethod': 'POST', 'request': {'$ref': 'File'},
+                               'response': {'$ref': 'File'}, 'supportsMediaUpload': True,
+                               'mediaUpload': {'accept': ['*/*'], 'protocols': {'simple': {'multipart': True, 'path': '/upload/drive/v2/files'},
+                                                                                'resumable': {'multipart': True, 'path': '/resumable/upload/drive/v2/files'}}}}}},
+                'permissions': {'methods': {
+                    'insert': {'id': 'drive.permissions.insert', 'path': 'files/{fileId}/permissions', 'httpMethod': 'POST',
+                               'parameters': fileIDParameter, 'parameterOrder': ['fileId'], 'request': {'$ref': 'Permission'},
+                               'response': {'$ref': 'Permission'}}}}}}
+
+    def describeFile(self, fileInfo):
+        description = dict([(key, value) for key, value in fileInfo.items() if key != 'data'])
+        description['kind'] = 'drive#file'
+        description['webContentLink'] = self.baseURL + 'download/' + fileInfo['id']
+        description['labels'] = {'trashed': False}
+        return description
+
+    def matches(self, fileInfo, query):
+        titles = re.findall(r"title\s*=\s*'((?:[^'\\]|\\.)*)'", query)
+        if titles and fileInfo['title'] not in [title.replace("\\'", "'") for title in titles]:
+            return False
+        match = re.search(r"mimeType\s*=\s*'([^']*)'", query)
+        if match and fileInfo['mimeType'] != match.group(1):
+            return False
+        match = re.search(r"'([^']*)'\s+in\s+parents", query)
+        if match and match.group(1) not in [parent['id'] for parent in fileInfo['parents']]:
+            return False
+        return True
+
+    def createFile(self, metadata, **fields):
+        fileInfo = {'id': uuid.uuid4().hex[:16], 'title': metadata.get('title', 'untitled'),
+                    'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+                    'parents': [{'id': parent['id']} for parent in metadata.get('parents', [])] or [{'id': 'root'}]}
+        fileInfo.update(fields)
+        self.files[fileInfo['id']] = fileInfo
+        return fileInfo
+
+    def dispatch(self, method, path, headers, body):
+        # returns the status, the headers and the body of the response
+        url = urlparse.urlparse(path)
+        query = urlparse.parse_qs(url.query)
+        jsonResponse = lambda status, data: (status, {'Content-Type': 'application/json'}, json.dumps(data))
+        if url.path.startswith('/discovery/'):
+            return jsonResponse(200, self.generateDiscoveryDocument())
+        if '/token' == url.path:
+            return jsonResponse(200, {'access_token': 'token', 'expires_in': 3600})
+        match = re.match(r'^/drive/v2/files/([^/]+)/permissions$', url.path)
+        if match and 'POST' == method:
+            if match.group(1) not in self.files:
+                return jsonResponse(404, {'error': {'code': 404, 'message': 'File not found'}})
+            return jsonResponse(200, dict(json.loads(body or '{}'), id = 'permission'))
+        match = re.match(r'^/drive/v2/files/([^/]+)$', url.path)
+        if match and 'GET' == method:
+            fileInfo = self.files.get(match.group(1))
+            if not fileInfo:
+                return jsonResponse(404, {'error': {'code': 404, 'message': 'File not found'}})
+            return jsonResponse(200, self.describeFile(fileInfo))
+        if '/drive/v2/files' == url.path and 'GET' == method:
+            fileQuery = query.get('q', [''])[0]
+            return jsonResponse(200, {'items': [self.describeFile(fileInfo) for fileInfo in self.files.values()
+                                                if fileInfo['id'] != 'root' and self.matches(fileInfo, fileQuery)]})
+        if '/drive/v2/files' == url.path and 'POST' == method:
+            return jsonResponse(200, self.describeFile(self.createFile(json.loads(body or '{}'))))
+        if url.path in ('/upload/drive/v2/files', '/resumable/upload/drive/v2/files'):
+            if 'POST' == method:
+                sessionID = uuid.uuid4().hex
+                self.sessions[sessionID] = {'metadata': json.loads(body or '{}'), 'data': bytearray(),
+                                            'size': int(headers.get('X-Upload-Content-Length', 0)) or None}
+                return 200, {'Location': self.baseURL + 'upload/drive/v2/files?uploadType=resumable&upload_id=' + sessionID}, ''
+            return self.putUploadData(self.sessions.get(query.get('upload_id', [''])[0]), headers, body)
+        if '/batch/drive/v2' == url.path and 'POST' == method:
+            return self.executeBatch(headers, body)
+        return 404, {}, 'unknown %s %s' % (method, path)
+
+    def putUploadData(self, session, headers, body):
+        if not session:
+            return 404, {}, 'no such session'
+        self.receivedBytes += len(body)
+        contentRange = headers.get('Content-Range', '')
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', contentRange)
+        if match:
+            if match.group(3) != '*':
+                session['size'] = int(match.group(3))
+            session['data'][int(match.group(1)):] = body
+        else:
+            match = re.match(r'bytes \*/(\d+)', contentRange)
+            if match:
+                session['size'] = int(match.group(1))
+            else:
+                session['data'][:] = body
+                session['size'] = len(body)
+        if session['size'] is not None and len(session['data']) >= session['size']:
+            data = str(session['data'])
+            fileInfo = self.createFile(session['metadata'], md5Checksum = hashlib.md5(data).hexdigest(), fileSize = str(len(data)))
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.describeFile(fileInfo))
+        responseHeaders = {'Range': 'bytes=0-%d' % (len(session['data']) - 1)} if session['data'] else {}
+        return 308, responseHeaders, ''
+
+    def executeBatch(self, headers, body):
+        boundary = re.search(r'boundary="?([^";]+)"?', headers.get('Content-Type', '')).group(1)
+        responseBoundary = 'batch_' + uuid.uuid4().hex
+        responses = []
+        for part in body.split('--' + boundary)[1:]:
+            if part.startswith('--'):
+                break
+            part = part.replace('\r\n', '\n')
+            partHeaders, _, request = part.lstrip('\n').partition('\n\n')
+            match = re.search(r'Content-ID:\s*<?([^>\n]+)>?', partHeaders, re.I)
+            contentID = match.group(1) if match else ''
+            requestLine, _, rest = request.partition('\n')
+            method, path = requestLine.split(' ')[:2]
+            requestHeaderLines, _, requestBody = rest.partition('\n\n')
+            requestHeaders = dict([[item.strip() for item in line.split(':', 1)] for line in requestHeaderLines.split('\n') if ':' in line])
+            url = urlparse.urlparse(path)
+            status, responseHeaders, responseBody = self.dispatch(method, url.path + ('?' + url.query if url.query else ''), requestHeaders, requestBody.rstrip('\n'))
+            response = 'HTTP/1.1 %d X\r\n%s\r\n%s' % (status, ''.join(['%s: %s\r\n' % item for item in responseHeaders.items()]), responseBody)
+            responses.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n%s\r\n' % (responseBoundary, contentID, response))
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + responseBoundary}, ''.join(responses) + '--%s--\r\n' % responseBoundary
+
+class DriveEmulatorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handleRequest(self, method):
+        emulator = self.server.emulator
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = []
+        receivedSize = 0
+        while receivedSize < length:
+            block = self.rfile.read(min(1 << 16, length - receivedSize))
+            if not block:
+                break
+            body.append(block)
+            receivedSize += len(block)
+            if emulator.rate:
+                # a slow link, one connection at a time
+                time.sleep(len(block) / float(emulator.rate))
+        if emulator.latency:
+            time.sleep(emulator.latency)
+        headers = dict([(key.title(), value) for key, value in self.headers.items()])
+        with emulator.lock:
+            status, responseHeaders, responseBody = emulator.dispatch(method, self.path, headers, ''.join(body))
+        self.send_response(status)
+        for key, value in responseHeaders.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(responseBody)))
+        self.end_headers()
+        self.wfile.write(responseBody)
+
+    def do_GET(self):
+        self.handleRequest('GET')
+
+    def do_POST(self):
+        self.handleRequest('POST')
+
+    def do_PUT(self):
+        self.handleRequest('PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+class DriveEmulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handlerClass):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handlerClass)
+        # the connections kept alive by the clients, each served by a thread of its own
+        self.connections = set()
+        self.connectionsLock = threading.Lock()
+
+    def finish_request(self, request, clientAddress):
+        with self.connectionsLock:
+            self.connections.add(request)
+        try:
+            BaseHTTPServer.HTTPServer.finish_request(self, request, clientAddress)
+        finally:
+            with self.connectionsLock:
+                self.connections.discard(request)
+
+    def close(self):
+        # stops serving and ends the threads of the open connections, which would otherwise wait for the clients
+        self.shutdown()
+        self.server_close()
+        with self.connectionsLock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+def startDriveEmulator(rate, latency):
+    server = DriveEmulatorServer(('127.0.0.1', 0), DriveEmulatorRequestHandler)
+    server.emulator = DriveEmulator(rate, latency)
+    server.emulator.baseURL = 'http://127.0.0.1:%d/' % server.socket.getsockname()[1]
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def writeDriveCredentials(credentialsPath, driveURL):
+    # credentials that the emulator accepts, so that no one has to authorize the release
+    from oauth2client.client import OAuth2Credentials
+    credentials = OAuth2Credentials('token', 'client_id', 'client_secret', 'refresh', datetime.datetime.utcnow() + datetime.timedelta(days = 1),
+                                    driveURL + 'token', 'benchmark')
+    with open(credentialsPath, 'w') as credentialsFile:
+        credentialsFile.write(credentials.to_json())
+
+class SMTPSinkChannel(smtpd.SMTPChannel):
+    # smtpd only speaks HELO, while the release logs in over EHLO
+    def smtp_EHLO(self, arg):
+        self.push('250-localhost\r\n250 AUTH PLAIN')
+
+    def smtp_AUTH(self, arg):
+        self.push('235 Authentication successful')
+
+    def smtp_RCPT(self, arg):
+        match = re.search(r'<([^>]*)>', arg or '')
+        address = match.group(1) if match else None
+        if address in self.sink.rejectedRecipients:
+            self.push('550 No such user')
+        elif self.sink.deferredRecipients.get(address):
+            self.sink.deferredRecipients[address] -= 1
+            self.push('450 Mailbox busy, try again later')
+        else:
+            smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+class SMTPSink(smtpd.SMTPServer):
+    # takes every message and keeps its envelope; deferredRecipients maps the addresses to defer to how many times
+    # they are deferred, and the addresses in rejectedRecipients are refused for good
+    def __init__(self, localaddr, remoteaddr):
+        smtpd.SMTPServer.__init__(self, localaddr, remoteaddr)
+        self.deferredRecipients = {}
+        self.rejectedRecipients = set()
+        self.messages = []
+
+    def handle_accept(self):
+        connection = self.accept()
+        if connection:
+            channel = SMTPSinkChannel(self, connection[0], connection[1])
+            channel.sink = self
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos))
+        return None
+
+def startSMTPSink():
+    sink = SMTPSink(('127.0.0.1', 0), None)
+    thread = threading.Thread(target = asyncore.loop, kwargs = {'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+    return sink
+
+def serve(rate, latency):
+    servers = {'ftp': startFTPServer(rate), 'drive': startDriveEmulator(rate, latency), 'smtp': startSMTPSink()}
+    print json.dumps(dict([(name, server.socket.getsockname()[1]) for name, server in servers.items()]))
+    sys.stdout.flush()
+    # the caller stops the stand-ins by closing their input
+    sys.stdin.read()
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if 'serve' == command:
+        serve(int(float(sys.argv[2])) if len(sys.argv) > 2 else 0, float(sys.argv[3]) if len(sys.argv) > 3 else 0)
+        return
+    tools = {'xcodebuild': runFakeXcodebuild, 'svn': runFakeSvn, 'svnversion': runFakeSvnversion}
+    sys.exit(tools[command](sys.argv[2:]))
+
+if '__main__' == __name__:
+    main()
@@ -1,33 +1,189 @@
 # -*- coding: utf-8 -*-
 
-from subprocess import Popen
+from subprocess import Popen, PIPE
 import os
-from datetime import date
+from datetime import date, datetime, timedelta
 import shlex
+import string
+import cgi
 import shutil
 import re
 import codecs
 import traceback
 import sys
 import urlparse
-import ftplib
 import json
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import webbrowser
-
-import httplib2
-from apiclient.discovery import build
-from apiclient.http import MediaFileUpload
-from apiclient.http import BatchHttpRequest
-from oauth2client.client import OAuth2WebServerFlow
-from oauth2client.file import Storage
+import copy
+import threading
+import Queue
+import hashlib
+import mmap
+import struct
+import binascii
+import argparse
+import collections
+import time
+import signal
+import functools
+import socket
+import httplib
+import contextlib
+import multiprocessing
+import heapq
+import itertools
+import urllib
+import urllib2
+import posixpath
+import BaseHTTPServer
+import SocketServer
 
 CREDENTIALS_FILE = 'credentials'
+DRIVE_FOLDER_CACHE_FILE = 'driveFolderCache.json'
+DRIVE_UPLOAD_JOURNAL_FILE = 'driveUploadJournal.json'
+DRIVE_DISCOVERY_CACHE_FILE = 'driveDiscovery.json'
 OAUTH_SCOPE = 'https://www.googleapis.com/auth/drive'
 REDIRECT_URI = 'urn:ietf:wg:oauth:2.0:oob'
 
+# bound by importGoogleAPIClient(), importFTPLib(), importParamiko() and importBoto3() once they are needed
+httplib2 = apiclient = oauth2client = None
+ftplib = None
+paramiko = None
+boto3 = botocore = None
+
+def importGoogleAPIClient():
+    # the Google API client takes longer to import than a build-only run takes to start,
+    # so it is imported once Google Drive is actually needed
+    global httplib2, apiclient, oauth2client
+    import httplib2
+    import apiclient.discovery
+    import apiclient.http
+    import apiclient.errors
+    import oauth2client.client
+    import oauth2client.file
+    
+def importFTPLib():
+    # only the releases that upload over FTP need it
+    global ftplib
+    import ftplib
+    
+def importParamiko():
+    # only the releases that upload over SFTP need it
+    global paramiko
+    import paramiko
+    
+def importBoto3():
+    # only the releases that upload to S3 need it
+    global boto3, botocore
+    import boto3
+    import boto3.s3.transfer
+    import botocore.config
+    import botocore.exceptions
+    
+class TraceSpan(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.bytes = 0
+        self.startTime = None
+        
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+        
+    def __exit__(self, excType, excValue, excTraceback):
+        if excType:
+            self.args['error'] = excType.__name__
+        self.tracer.record(self, time.time())
+        return False
+        
+    def addBytes(self, count):
+        self.bytes += count
+        
+class NullTraceSpan(object):
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, excType, excValue, excTraceback):
+        return False
+        
+    def addBytes(self, count):
+        pass
+        
+class Tracer(object):
+    nullSpan = NullTraceSpan()
+    
+    def __init__(self):
+        self.enabled = False
+        self.startTime = time.time()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threadNames = {}
+        
+    def enable(self):
+        self.enabled = True
+        self.startTime = time.time()
+        
+    def span(self, name, **args):
+        # the shared null span keeps disabled tracing down to one attribute check
+        if not self.enabled:
+            return Tracer.nullSpan
+        return TraceSpan(self, name, args)
+        
+    def record(self, span, endTime):
+        thread = threading.current_thread()
+        if span.bytes:
+            span.args['bytes'] = span.bytes
+        with self.lock:
+            self.threadNames[thread.ident] = thread.name
+            self.events.append((span.name, span.startTime, endTime, thread.ident, span.args, span.bytes))
+            
+    def writeChromeTrace(self, filePath):
+        processID = os.getpid()
+        traceEvents = [{'name': 'thread_name', 'ph': 'M', 'pid': processID, 'tid': threadID, 'args': {'name': threadName}}\
+                       for threadID, threadName in self.threadNames.iteritems()]
+        for name, startTime, endTime, threadID, args, byteCount in self.events:
+            traceEvents.append({
+                'name': name,
+                'ph': 'X',
+                'ts': int((startTime - self.startTime) * 1000000),
+                'dur': int((endTime - startTime) * 1000000),
+                'pid': processID,
+                'tid': threadID,
+                'args': args
+            })
+        with open(filePath, 'w') as traceFile:
+            json.dump({'traceEvents': traceEvents, 'displayTimeUnit': 'ms'}, traceFile)
+        print 'trace written to %s' % filePath
+        
+    def printSummary(self):
+        summary = collections.OrderedDict()
+        for name, startTime, endTime, threadID, args, byteCount in sorted(self.events, key = lambda event: event[1]):
+            entry = summary.setdefault(name, [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += endTime - startTime
+            entry[2] = max(entry[2], endTime - startTime)
+            entry[3] += byteCount
+        print '%-24s %6s %10s %10s %10s %8s' % ('stage', 'count', 'total(s)', 'max(s)', 'MB', 'MB/s')
+        for name, (count, total, longest, byteCount) in summary.iteritems():
+            if byteCount:
+                print '%-24s %6d %10.2f %10.2f %10.1f %8.2f' % (name[:24], count, total, longest, byteCount / 1048576.0, byteCount / 1048576.0 / max(total, 0.001))
+            else:
+                print '%-24s %6d %10.2f %10.2f' % (name[:24], count, total, longest)
+        
+tracer = Tracer()
+
+def traced(name, describe = None):
+    def decorate(function):
+        @functools.wraps(function)
+        def tracedFunction(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(name, **(describe(*args, **kwargs) if describe else {})):
+                return function(*args, **kwargs)
+        return tracedFunction
+    return decorate
+    
 class BaseEditor(object):
     def __init__(self, filePath):
         self.fileHandle = codecs.open(filePath, 'r+', 'utf-8')
@@ -42,22 +198,282 @@ class BaseEditor(object):
     def discard(self):
         self.fileHandle.close()
 
-class PlistEditor(BaseEditor):
+def writeFileAtomically(filePath, data):
+    # write beside the target and rename so that a crash never leaves half a file behind
+    directory = os.path.split(filePath)[0]
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporaryPath = '%s.%d.tmp' % (filePath, threading.current_thread().ident)
+    with open(temporaryPath, 'wb') as fileHandle:
+        fileHandle.write(data)
+    if os.path.exists(filePath):
+        shutil.copymode(filePath, temporaryPath)
+    os.rename(temporaryPath, filePath)
+    
+class PlistDocument(object):
+    # parses a plist once, keeps the edits in memory and writes the file only when they change it.
+    # The values of an XML plist are edited where they are, so the diff shows nothing but the edits
+    tagPattern = re.compile(r'<!--.*?-->|<\?.*?\?>|<!DOCTYPE[^>]*>|<(/?)([A-Za-z]+)[^>]*?(/?)>', re.DOTALL)
+    textTypes = set(['string', 'integer', 'real', 'date', 'data'])
+    
     def __init__(self, filePath):
-        super(PlistEditor, self).__init__(filePath)
-    
-    def replaceSimpleValue(self, key, value, valueType = 'string'):
-        pattern = r'<key>%s</key>\s*<%s>[^<>]+</%s>' % (key, valueType, valueType)
-        substitute = '<key>%s</key>\n\t<%s>%s</%s>' % (key, valueType, value, valueType)
-        self.fileData = re.sub(pattern, substitute, self.fileData, flags = re.IGNORECASE)
-        
-    def readSimpleValue(self, key, valueType = 'string'):
-        pattern = r'<key>%s</key>\s*<%s>([^<>]+)</%s>' % (key, valueType, valueType)
-        match = re.search(pattern, self.fileData, flags = re.IGNORECASE)
-        if match is not None:
-            return match.group(1)
+        self.filePath = filePath
+        with open(filePath, 'rb') as fileHandle:
+            self.load(fileHandle.read())
+        
+    def load(self, data):
+        self.data = data
+        self.edits = collections.OrderedDict()
+        self.isBinary = data.startswith('bplist00')
+        if self.isBinary:
+            self.root = BinaryPlistReader(data).read()
         else:
+            self.text = data.decode('utf-8')
+            self.indexEntries()
+            
+    def indexEntries(self):
+        # the position of every value of the top-level dictionary, found in a single pass
+        self.entries = {}
+        self.rootEnd = None
+        openElements = []
+        key = None
+        for match in PlistDocument.tagPattern.finditer(self.text):
+            isClosing, tag, isSelfClosing = match.groups()
+            if not tag:
+                continue
+            if not isClosing and not isSelfClosing:
+                openElements.append((tag, match.start(), match.end()))
+                continue
+            if isSelfClosing:
+                start, textStart = match.start(), None
+            else:
+                tag, start, textStart = openElements.pop()
+            if len(openElements) == 2:
+                if 'key' == tag:
+                    key = self.unescape(self.text[textStart:match.start()])
+                elif key is not None:
+                    self.entries[key] = (start, match.end(), tag, textStart, match.start() if textStart else None)
+                    key = None
+            elif len(openElements) == 1 and 'dict' == tag:
+                self.rootEnd = match.start()
+                
+    def unescape(self, text):
+        from xml.sax.saxutils import unescape
+        return unescape(text, {'&quot;': '"', '&apos;': "'"})
+        
+    def getValue(self, key):
+        if key in self.edits:
+            return self.edits[key]
+        return self.getSavedValue(key)
+        
+    def getSavedValue(self, key):
+        if self.isBinary:
+            return self.root.get(key)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        start, end, tag, textStart, textEnd = entry
+        if tag in ('true', 'false'):
+            return 'true' == tag
+        if tag not in PlistDocument.textTypes:
             return None
+        text = self.unescape(self.text[textStart:textEnd]) if textStart else ''
+        return {'integer': int, 'real': float}.get(tag, lambda text: text)(text)
+        
+    def setValue(self, key, value):
+        self.edits[key] = value
+        
+    def hasChanges(self):
+        return any(self.getSavedValue(key) != value for key, value in self.edits.iteritems())
+        
+    def render(self):
+        # the contents of the file with the edits applied
+        if not self.edits:
+            return self.data
+        if self.isBinary:
+            root = collections.OrderedDict(self.root)
+            root.update(self.edits)
+            return BinaryPlistWriter().write(root)
+        replacements = []
+        for key, value in self.edits.iteritems():
+            tag, text = PlistDocument.describeValue(value)
+            entry = self.entries.get(key)
+            if entry and entry[2] == tag and entry[3]:
+                replacements.append((entry[3], entry[4], text))
+            elif entry:
+                replacements.append((entry[0], entry[1], PlistDocument.formatElement(tag, text)))
+            else:
+                replacements.append((self.rootEnd, self.rootEnd, '\t<key>%s</key>\n\t%s\n' % (cgi.escape(key), PlistDocument.formatElement(tag, text))))
+        output = []
+        position = 0
+        for start, end, text in sorted(replacements, key = lambda replacement: replacement[0]):
+            output.append(self.text[position:start])
+            output.append(text)
+            position = end
+        output.append(self.text[position:])
+        return ''.join(output).encode('utf-8')
+        
+    @staticmethod
+    def describeValue(value):
+        if isinstance(value, bool):
+            return ('true' if value else 'false'), None
+        if isinstance(value, (int, long)):
+            return 'integer', str(value)
+        if isinstance(value, float):
+            return 'real', repr(value)
+        return 'string', cgi.escape(value if isinstance(value, unicode) else str(value).decode('utf-8'))
+        
+    @staticmethod
+    def formatElement(tag, text):
+        return '<%s/>' % tag if text is None else '<%s>%s</%s>' % (tag, text, tag)
+        
+    def save(self):
+        # returns whether the file was written
+        if not self.hasChanges():
+            self.edits.clear()
+            return False
+        data = self.render()
+        writeFileAtomically(self.filePath, data)
+        self.load(data)
+        return True
+        
+    def clone(self, filePath):
+        # the saved contents under another path, without parsing them again
+        writeFileAtomically(filePath, self.data)
+        document = copy.copy(self)
+        document.filePath = filePath
+        document.edits = collections.OrderedDict()
+        return document
+        
+class BinaryPlistReader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offsetSize, self.referenceSize, objectCount, self.topObject, offsetTableOffset = struct.unpack('>6xBBQQQ', data[-32:])
+        self.offsets = [self.readInteger(offsetTableOffset + index * self.offsetSize, self.offsetSize) for index in xrange(objectCount)]
+        
+    def readInteger(self, position, size):
+        return int(binascii.hexlify(self.data[position:position + size]), 16)
+        
+    def readLength(self, info, position):
+        if info != 0xF:
+            return info, position
+        size = 1 << (ord(self.data[position]) & 0xF)
+        return self.readInteger(position + 1, size), position + 1 + size
+        
+    def read(self):
+        return self.readObject(self.topObject)
+        
+    def readObject(self, reference):
+        import plistlib
+        
+        position = self.offsets[reference]
+        marker = ord(self.data[position])
+        objectType, info = marker >> 4, marker & 0xF
+        if 0x0 == objectType:
+            return {0x0: None, 0x8: False, 0x9: True}[info]
+        if 0x1 == objectType:
+            size = 1 << info
+            value = self.readInteger(position + 1, size)
+            # only integers of 8 bytes and more are signed
+            return value - (1 << (size * 8)) if size >= 8 and value >> (size * 8 - 1) else value
+        if 0x2 == objectType:
+            return struct.unpack('>f' if 2 == info else '>d', self.data[position + 1:position + 1 + (1 << info)])[0]
+        if 0x3 == objectType:
+            return datetime(2001, 1, 1) + timedelta(seconds = struct.unpack('>d', self.data[position + 1:position + 9])[0])
+        length, position = self.readLength(info, position + 1)
+        if 0x4 == objectType:
+            return plistlib.Data(self.data[position:position + length])
+        if 0x5 == objectType:
+            return self.data[position:position + length].decode('ascii')
+        if 0x6 == objectType:
+            return self.data[position:position + length * 2].decode('utf-16-be')
+        references = [self.readInteger(position + index * self.referenceSize, self.referenceSize) for index in xrange(length * (2 if 0xD == objectType else 1))]
+        if 0xA == objectType:
+            return [self.readObject(reference) for reference in references]
+        if 0xD == objectType:
+            return collections.OrderedDict(zip([self.readObject(reference) for reference in references[:length]],
+                                               [self.readObject(reference) for reference in references[length:]]))
+        raise ValueError('object type 0x%x of binary plists is not supported' % objectType)
+        
+class BinaryPlistWriter(object):
+    def __init__(self):
+        self.objects = []
+        
+    def write(self, root):
+        self.flatten(root)
+        referenceSize = BinaryPlistWriter.sizeOf(len(self.objects))
+        output = ['bplist00']
+        position = len(output[0])
+        offsets = []
+        for value, references in self.objects:
+            offsets.append(position)
+            encodedObject = self.encodeObject(value, references, referenceSize)
+            output.append(encodedObject)
+            position += len(encodedObject)
+        offsetSize = BinaryPlistWriter.sizeOf(position)
+        output.extend([BinaryPlistWriter.packInteger(offset, offsetSize) for offset in offsets])
+        output.append(struct.pack('>6xBBQQQ', offsetSize, referenceSize, len(self.objects), 0, position))
+        return ''.join(output)
+        
+    def flatten(self, value):
+        # objects are numbered depth first, so the root is object 0
+        index = len(self.objects)
+        self.objects.append(None)
+        if isinstance(value, dict):
+            references = [self.flatten(key) for key in value] + [self.flatten(item) for item in value.itervalues()]
+        elif isinstance(value, (list, tuple)):
+            references = [self.flatten(item) for item in value]
+        else:
+            references = None
+        self.objects[index] = (value, references)
+        return index
+        
+    @staticmethod
+    def sizeOf(maximum):
+        for size in (1, 2, 4):
+            if maximum < 1 << (size * 8):
+                return size
+        return 8
+        
+    @staticmethod
+    def packInteger(value, size):
+        return struct.pack({1: '>B', 2: '>H', 4: '>I', 8: '>Q'}[size], value)
+        
+    def encodeLength(self, objectType, length):
+        if length < 0xF:
+            return chr(objectType << 4 | length)
+        return chr(objectType << 4 | 0xF) + self.encodeObject(length, None, None)
+        
+    def encodeObject(self, value, references, referenceSize):
+        import plistlib
+        
+        if references is not None:
+            objectType = 0xD if isinstance(value, dict) else 0xA
+            length = len(references) / 2 if 0xD == objectType else len(references)
+            return self.encodeLength(objectType, length) + ''.join([BinaryPlistWriter.packInteger(reference, referenceSize) for reference in references])
+        if value is None:
+            return '\x00'
+        if isinstance(value, bool):
+            return '\x09' if value else '\x08'
+        if isinstance(value, (int, long)):
+            if value < 0:
+                return '\x13' + struct.pack('>q', value)
+            size = BinaryPlistWriter.sizeOf(value)
+            return chr(0x10 | {1: 0, 2: 1, 4: 2, 8: 3}[size]) + BinaryPlistWriter.packInteger(value, size)
+        if isinstance(value, float):
+            return '\x23' + struct.pack('>d', value)
+        if isinstance(value, datetime):
+            seconds = value - datetime(2001, 1, 1)
+            return '\x33' + struct.pack('>d', seconds.days * 86400 + seconds.seconds + seconds.microseconds / 1e6)
+        if isinstance(value, plistlib.Data):
+            return self.encodeLength(0x4, len(value.data)) + value.data
+        if not isinstance(value, unicode):
+            value = str(value).decode('utf-8')
+        try:
+            return self.encodeLength(0x5, len(value)) + value.encode('ascii')
+        except UnicodeEncodeError:
+            encodedValue = value.encode('utf-16-be')
+            return self.encodeLength(0x6, len(encodedValue) / 2) + encodedValue
             
 class BaseBuilderModel(object):
     def __init__(self, buildInfo):
@@ -74,6 +490,10 @@ class BaseBuilderModel(object):
     def __unicode__(self):
         return u'%s(%s)' % (self.buildName, self.buildNumber)
         
+    def resolvePath(self, path):
+        # the paths in the config are relative to the project folder
+        return os.path.normpath(os.path.join(self.buildInfo.get('PROJECT_PATH', ''), path))
+        
     def getBuildName(self, buildProfile, appBuild = None):
         pass
         
@@ -81,16 +501,33 @@ class BaseBuilderModel(object):
         pass
         
     def nextBuildPathInfo(self, currentAppBuild, buildProfile):
-        self.buildNumber = self.incrementBuildNumber(currentAppBuild)
-        self.buildName = self.getBuildName(buildProfile, self.buildNumber)
+        buildNumber = self.incrementBuildNumber(currentAppBuild)
+        self.setBuildPathInfo(buildNumber, self.getBuildName(buildProfile, buildNumber))
+        
+    def setBuildPathInfo(self, buildNumber, buildName):
+        self.buildNumber = buildNumber
+        self.buildName = buildName
         
 class IpaBuilderModel(BaseBuilderModel):
     def __init__(self, buildInfo):
         super(IpaBuilderModel, self).__init__(buildInfo)
         
-        self.outputFolder = os.path.join(self['EXPORT_PATH_PREFIX'], self['BUILD_FOLDER'])
+        self.outputFolder = os.path.join(self.resolvePath(self['EXPORT_PATH_PREFIX']), self['BUILD_FOLDER'])
         self.archivePath = None
         self.exportPath = None
+        self.infoPlistPath = None
+        self.derivedDataPath = None
+        
+    def getProfileName(self, buildProfile):
+        components = [buildProfile['scheme'], buildProfile['ipaNameSuffix'], buildProfile['bundleIdentifier']]
+        return re.sub(r'[^\w.-]+', '_', '_'.join([c for c in components if c]))
+        
+    def isolateBuildPaths(self, buildProfile):
+        workFolder = os.path.abspath(os.path.join(self.outputFolder, 'work', self.getProfileName(buildProfile)))
+        if not os.path.isdir(workFolder):
+            os.makedirs(workFolder)
+        self.infoPlistPath = os.path.join(workFolder, os.path.split(self['INFO_PLIST_PATH'])[1])
+        self.derivedDataPath = os.path.join(workFolder, 'DerivedData')
         
     def getBuildName(self, buildProfile, appBuild = None):
         def generateCurrentDateString():
@@ -115,6 +552,9 @@ class IpaBuilderModel(BaseBuilderModel):
         
     def nextBuildPathInfo(self, currentAppBuild, buildProfile):
         super(IpaBuilderModel, self).nextBuildPathInfo(currentAppBuild if self['INCREMENT_BUILD_NUMBER'] else None, buildProfile)
+        
+    def setBuildPathInfo(self, buildNumber, buildName):
+        super(IpaBuilderModel, self).setBuildPathInfo(buildNumber, buildName)
         self.archivePath = os.path.join(self.outputFolder, 'archives', self.buildName + '.xcarchive')
         self.exportPath = os.path.join(self.outputFolder, self.buildName + '.ipa')
         
@@ -126,29 +566,902 @@ def generateUniqueFileName(fileName):
         fileName = '%s_%d%s' % (nameTuple[0], number, nameTuple[1])
     return fileName
     
-def issueCommand(command):
-    print 'issue', command
-    if isinstance(command, unicode):
-        command = command.encode('utf-8')
-    arguments = shlex.split(command)
-    
-    logFile = generateUniqueFileName('issueCommandLog')
-    pOut = open(logFile, 'w+')
-    p = Popen(arguments, stdout = pOut)
-    p.wait()
-    pOut.close()
-    if p.returncode != os.EX_OK:
-        print 'returns %s. Refer to %s for details.' % (str(p.returncode), logFile)
-    else:
-        os.remove(logFile)
-    return os.EX_OK == p.returncode
+logFileLock = threading.Lock()
+
+class CommandResult(object):
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.timedOut = False
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.peakRSS = 0
+        self.tail = []
+        self.logFile = None
+        
+    def succeeded(self):
+        return os.EX_OK == self.returncode and not self.timedOut
+        
+class CommandRunner(object):
+    terminationGracePeriod = 5
+    
+    def __init__(self, workingDirectory = None):
+        # commands run in workingDirectory, so that releases of several projects can share the process
+        self.workingDirectory = workingDirectory
+        self.commandTimeout = None
+        self.deadline = None
+        self.tailLines = 30
+        self.showsOutput = False
+        self.printLock = threading.Lock()
+        self.statisticsLock = threading.Lock()
+        self.statistics = []
+        
+    def setOverallTimeout(self, timeout):
+        self.deadline = time.time() + timeout if timeout else None
+        
+    def run(self, command, timeout = None, label = None, outputHandler = None):
+        self.printLine('issue %s' % command)
+        if isinstance(command, unicode):
+            command = command.encode('utf-8')
+        arguments = shlex.split(command)
+        result = CommandResult(command)
+        
+        # concurrent builds must not pick the same log file
+        with logFileLock:
+            result.logFile = generateUniqueFileName(os.path.join(self.workingDirectory or '', 'issueCommandLog'))
+            logHandle = open(result.logFile, 'w+')
+        logLock = threading.Lock()
+        tail = collections.deque(maxlen = self.tailLines)
+        # the reader that finishes last closes the log, which may be after run() has given up waiting for them
+        openStreams = [2]
+        
+        def readStream(stream, streamName):
+            for line in iter(stream.readline, ''):
+                with logLock:
+                    logHandle.write(line)
+                    tail.append(line)
+                if self.showsOutput:
+                    # whole lines only, so that concurrent commands do not interleave within a line
+                    with self.printLock:
+                        sys.stdout.write('[%s] %s' % (label, line) if label else line)
+                        sys.stdout.flush()
+                if outputHandler:
+                    outputHandler(streamName, line)
+            stream.close()
+            with logLock:
+                openStreams[0] -= 1
+                if not openStreams[0]:
+                    logHandle.close()
+        
+        startTime = time.time()
+        deadlines = [startTime + (timeout or self.commandTimeout)] if timeout or self.commandTimeout else []
+        if self.deadline:
+            deadlines.append(self.deadline)
+        try:
+            # a process group of its own lets a timeout take down everything the command spawned
+            p = Popen(arguments, stdout = PIPE, stderr = PIPE, close_fds = True, preexec_fn = os.setpgrp, cwd = self.workingDirectory)
+        except:
+            logHandle.close()
+            raise
+        readers = [threading.Thread(target = readStream, args = (p.stdout, 'stdout')),\
+                   threading.Thread(target = readStream, args = (p.stderr, 'stderr'))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        status, usage = self.waitForProcess(p.pid, min(deadlines) if deadlines else None, result)
+        # reap it ourselves so that Popen does not try again
+        p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        # a process the command left behind may hold the pipes open for longer
+        for reader in readers:
+            reader.join(CommandRunner.terminationGracePeriod)
+        with logLock:
+            result.tail = list(tail)
+            
+        result.returncode = p.returncode
+        result.wallTime = time.time() - startTime
+        result.cpuTime = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+        result.peakRSS = usage.ru_maxrss * (1 if 'darwin' == sys.platform else 1024)
+        with self.statisticsLock:
+            self.statistics.append(result)
+            
+        timing = '%.1fs, cpu %.1fs, peak RSS %.1f MB' % (result.wallTime, result.cpuTime, result.peakRSS / 1048576.0)
+        if result.succeeded():
+            self.printLine('%s done in %s' % (label or arguments[0], timing))
+            os.remove(result.logFile)
+        elif result.timedOut:
+            self.printLine('%s timed out after %s and was killed. Refer to %s for details.' % (label or arguments[0], timing, result.logFile), result.tail)
+        else:
+            self.printLine('returns %s. Refer to %s for details.' % (str(p.returncode), result.logFile), result.tail)
+        return result
+        
+    def issue(self, command, timeout = None, label = None):
+        return self.run(command, timeout, label).succeeded()
+        
+    def readOutput(self, command, label = None):
+        # returns the standard output of a command, or None if it fails
+        output = []
+        def collectOutput(streamName, line):
+            if 'stdout' == streamName:
+                output.append(line)
+        if not self.run(command, label = label, outputHandler = collectOutput).succeeded():
+            return None
+        return ''.join(output)
+        
+    def printLine(self, message, tail = None):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        with self.printLock:
+            sys.stdout.write(message + '\n')
+            if tail:
+                sys.stdout.write(''.join(tail))
+            sys.stdout.flush()
+        
+    def waitForProcess(self, pid, deadline, result):
+        interval = 0.01
+        while True:
+            waitedPID, status, usage = os.wait4(pid, os.WNOHANG)
+            if waitedPID:
+                return status, usage
+            if deadline and time.time() > deadline:
+                result.timedOut = True
+                return self.terminateProcessGroup(pid)
+            time.sleep(interval)
+            interval = min(interval * 2, 0.2)
+            
+    def terminateProcessGroup(self, pid):
+        for signalNumber in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pid, signalNumber)
+            except OSError:
+                pass
+            graceDeadline = time.time() + CommandRunner.terminationGracePeriod
+            while time.time() < graceDeadline or signalNumber == signal.SIGKILL:
+                waitedPID, status, usage = os.wait4(pid, os.WNOHANG)
+                if waitedPID:
+                    return status, usage
+                time.sleep(0.1)
+                
+commandRunner = CommandRunner()
+
+def issueCommand(command, timeout = None, label = None):
+    return commandRunner.issue(command, timeout, label)
+    
+def readCommandOutput(command, label = None):
+    return commandRunner.readOutput(command, label)
+    
+WorkingCopyStatus = collections.namedtuple('WorkingCopyStatus', ['isCurrent', 'modifiedPaths'])
+
+class VersionControl(object):
+    name = None
+    
+    def __init__(self, buildInfo, commandRunner = commandRunner):
+        self.buildInfo = buildInfo
+        self.commandRunner = commandRunner
+        
+    def getStatus(self, checksRemote):
+        # returns a WorkingCopyStatus, whose isCurrent is None unless the remote is checked, or None if it is unknown
+        pass
+        
+    def getRevision(self):
+        pass
+        
+    def hasLocalChanges(self, path):
+        status = self.getStatus(False)
+        return status is None or bool(status.modifiedPaths and any(isSameOrInsidePath(modifiedPath, path) for modifiedPath in status.modifiedPaths))
+        
+    def resolvePath(self, path):
+        # the paths are printed relative to the folder the commands run in
+        return os.path.join(self.commandRunner.workingDirectory or '', path)
+        
+    def update(self):
+        pass
+        
+    def commit(self, message, path):
+        pass
+        
+class SvnVersionControl(VersionControl):
+    name = 'svn'
+    unmodifiedItems = set(['normal', 'none', 'unversioned', 'ignored', 'external'])
+    
+    def getStatus(self, checksRemote):
+        from xml.etree import cElementTree
+        # -u asks the repository whether anything is out of date in the same call
+        command = 'svn status --xml -q %s' % ('-u %s' % generateSvnAuthOptions(self.buildInfo) if checksRemote else '')
+        output = self.commandRunner.readOutput(command.strip())
+        if output is None:
+            return None
+        isCurrent = True if checksRemote else None
+        modifiedPaths = []
+        for entry in cElementTree.fromstring(output).iter('entry'):
+            WCStatus = entry.find('wc-status')
+            if WCStatus is not None and WCStatus.get('item') not in SvnVersionControl.unmodifiedItems:
+                modifiedPaths.append(self.resolvePath(entry.get('path')))
+            reposStatus = entry.find('repos-status')
+            if reposStatus is not None and reposStatus.get('item', 'none') != 'none':
+                isCurrent = False
+        return WorkingCopyStatus(isCurrent, modifiedPaths)
+        
+    def getRevision(self):
+        # the newest revision anything in the working copy was changed in, which a commit or an update
+        # of nothing but revisions outside the working copy does not make ambiguous
+        output = self.commandRunner.readOutput('svnversion -c')
+        revisions = re.findall(r'\d+', output or '')
+        return int(revisions[-1]) if revisions else None
+        
+    def update(self):
+        return self.commandRunner.issue('svn update')
+        
+    def commit(self, message, path):
+        commitOptions = [optionGenerator('-m', message), generateSvnAuthOptions(self.buildInfo)]
+        return self.commandRunner.issue('svn commit %s "%s"' % (' '.join([option for option in commitOptions if option]), path))
+        
+class GitVersionControl(VersionControl):
+    name = 'git'
+    
+    def __init__(self, buildInfo, commandRunner = commandRunner):
+        super(GitVersionControl, self).__init__(buildInfo, commandRunner)
+        self.topLevelFolder = None
+        
+    def getStatus(self, checksRemote):
+        output = self.commandRunner.readOutput('git status --porcelain --untracked-files=no')
+        if output is None:
+            return None
+        # the path starts after the two status letters; a rename is listed as "from -> to"
+        modifiedPaths = [self.resolvePath(line[3:].split(' -> ')[-1].strip('"')) for line in output.splitlines() if line.strip()]
+        if None in modifiedPaths:
+            return None
+        isCurrent = None
+        if checksRemote and self.commandRunner.issue('git fetch --quiet'):
+            behindCount = self.commandRunner.readOutput('git rev-list --count HEAD..@{upstream}')
+            isCurrent = behindCount is not None and behindCount.strip() == '0'
+        return WorkingCopyStatus(isCurrent, modifiedPaths)
+        
+    def resolvePath(self, path):
+        # porcelain paths are relative to the top of the repository, not to the folder the commands run in
+        if self.topLevelFolder is None:
+            output = self.commandRunner.readOutput('git rev-parse --show-cdup')
+            if output is None:
+                return None
+            self.topLevelFolder = os.path.normpath(super(GitVersionControl, self).resolvePath(output.strip()))
+        return os.path.join(self.topLevelFolder, path)
+        
+    def getRevision(self):
+        output = self.commandRunner.readOutput('git rev-parse HEAD')
+        return output.strip() if output else None
+        
+    def update(self):
+        return self.commandRunner.issue('git pull --ff-only')
+        
+    def commit(self, message, path):
+        return self.commandRunner.issue('git commit %s -- "%s"' % (optionGenerator('-m', message), path)) and self.commandRunner.issue('git push')
+        
+def createVersionControl(buildInfo, commandRunner = commandRunner):
+    versionControlClasses = {'svn': SvnVersionControl, 'git': GitVersionControl}
+    return versionControlClasses[buildInfo.get('VERSION_CONTROL', 'svn')](buildInfo, commandRunner)
+    
+def isSameOrInsidePath(path, folderPath):
+    path = os.path.abspath(path)
+    folderPath = os.path.abspath(folderPath)
+    return path == folderPath or path.startswith(folderPath.rstrip(os.sep) + os.sep)
+    
+def loadJSONFile(filePath, default = None):
+    if not os.path.isfile(filePath):
+        return default
+    try:
+        with open(filePath, 'r') as fileHandle:
+            return json.load(fileHandle)
+    except ValueError:
+        print '%s is corrupted and will be rebuilt' % filePath
+        return default
+        
+def saveJSONFile(filePath, data):
+    writeFileAtomically(filePath, json.dumps(data, indent = 1, sort_keys = True))
+    
+class BuildCache(object):
+    # maps a fingerprint of everything an archive is built from to the archive built from it
+    excludedFolderNames = set(['.svn', '.git', '.hg', 'build', 'DerivedData', 'xcuserdata'])
+    excludedFileNames = set(['.DS_Store'])
+    
+    def __init__(self, indexPath):
+        self.indexPath = indexPath
+        self.lock = threading.Lock()
+        index = loadJSONFile(indexPath, {})
+        self.archives = index.get('archives', {})
+        # (size, mtime, digest) of every source file, so only files that changed are read again
+        self.fileDigests = index.get('files', {})
+        
+    def fingerprintSourceTree(self, rootPath, excludedPaths):
+        excludedPaths = set([os.path.abspath(path) for path in excludedPaths])
+        treeHash = hashlib.sha1()
+        fileDigests = {}
+        for directory, folderNames, fileNames in os.walk(rootPath):
+            folderNames[:] = sorted([name for name in folderNames if name not in BuildCache.excludedFolderNames and\
+                                     os.path.abspath(os.path.join(directory, name)) not in excludedPaths])
+            for fileName in sorted(fileNames):
+                filePath = os.path.join(directory, fileName)
+                if fileName in BuildCache.excludedFileNames or os.path.abspath(filePath) in excludedPaths or not os.path.isfile(filePath):
+                    continue
+                relativePath = os.path.relpath(filePath, rootPath)
+                fileStat = os.stat(filePath)
+                cachedDigest = self.fileDigests.get(relativePath)
+                if cachedDigest and cachedDigest[0] == fileStat.st_size and cachedDigest[1] == fileStat.st_mtime:
+                    digest = cachedDigest[2]
+                else:
+                    digest = hashFile(filePath, hashlib.sha1)
+                fileDigests[relativePath] = [fileStat.st_size, fileStat.st_mtime, digest]
+                treeHash.update('%s\0%s\0' % (relativePath.encode('utf-8') if isinstance(relativePath, unicode) else relativePath, digest))
+        with self.lock:
+            self.fileDigests = fileDigests
+            self.save()
+        return treeHash.hexdigest()
+        
+    def lookup(self, fingerprint):
+        archivePath = self.archives.get(fingerprint)
+        if archivePath and os.path.isdir(archivePath):
+            return archivePath
+        return None
+        
+    def store(self, fingerprint, archivePath):
+        with self.lock:
+            self.forgetPath(archivePath)
+            self.archives[fingerprint] = os.path.abspath(archivePath)
+            self.save()
+            
+    def forget(self, archivePath):
+        with self.lock:
+            if self.forgetPath(archivePath):
+                self.save()
+                
+    def forgetPath(self, archivePath):
+        # an archive that is rebuilt in place no longer matches the fingerprints it was stored under
+        archivePath = os.path.abspath(archivePath)
+        staleFingerprints = [fingerprint for fingerprint, path in self.archives.iteritems() if path == archivePath]
+        for fingerprint in staleFingerprints:
+            del self.archives[fingerprint]
+        return bool(staleFingerprints)
+            
+    def save(self):
+        saveJSONFile(self.indexPath, {'archives': self.archives, 'files': self.fileDigests})
+        
+class ArtifactStore(object):
+    # indexes the archives and ipas under the output folder and removes the old ones; the work folder of BUILD_WORKERS is left alone
+    def __init__(self, outputFolder, sizeLimit = None, keptPerProfile = None):
+        self.outputFolder = os.path.abspath(outputFolder)
+        self.indexPath = os.path.join(self.outputFolder, 'artifacts.json')
+        self.sizeLimit = sizeLimit
+        self.keptPerProfile = keptPerProfile
+        self.lock = threading.Lock()
+        # called with every evicted artifact
+        self.onEvicted = None
+        # artifacts of the current release are never evicted
+        self.usedBuildNames = set()
+        self.artifacts = loadJSONFile(self.indexPath, None)
+        if self.artifacts is None:
+            self.artifacts = {}
+            self.adoptUntrackedArtifacts()
+            
+    def adoptUntrackedArtifacts(self):
+        # artifacts built before there was an index belong to no profile, but still count towards the size limit
+        candidates = [(os.path.join(self.outputFolder, 'archives'), '.xcarchive', 'archivePath'), (self.outputFolder, '.ipa', 'exportPath')]
+        for folder, extension, key in candidates:
+            if not os.path.isdir(folder):
+                continue
+            for fileName in os.listdir(folder):
+                buildName, fileExtension = os.path.splitext(fileName)
+                if fileExtension != extension:
+                    continue
+                filePath = os.path.join(folder, fileName)
+                artifact = self.artifacts.setdefault(buildName, {'profile': None, 'buildNumber': None, 'archivePath': None, 'exportPath': None})
+                artifact[key] = filePath
+                artifact['createdTime'] = artifact['lastUsedTime'] = max(artifact.get('createdTime', 0), os.path.getmtime(filePath))
+        for artifact in self.artifacts.itervalues():
+            artifact['archiveSize'] = measurePath(artifact['archivePath'])
+            artifact['exportSize'] = measurePath(artifact['exportPath'])
+        if self.artifacts:
+            self.save()
+            
+    def register(self, profileName, buildNumber, buildName, archivePath, exportPath):
+        # the archive may be shared with an older build when it came from the build cache
+        currentTime = time.time()
+        with self.lock:
+            artifact = self.artifacts.get(buildName) or {'createdTime': currentTime}
+            artifact.update({
+                'profile': profileName,
+                'buildNumber': buildNumber,
+                'archivePath': os.path.abspath(archivePath),
+                'exportPath': os.path.abspath(exportPath),
+                'archiveSize': measurePath(archivePath),
+                'exportSize': measurePath(exportPath),
+                'lastUsedTime': currentTime
+            })
+            self.artifacts[buildName] = artifact
+            self.usedBuildNames.add(buildName)
+            self.save()
+            
+    def touch(self, exportPath):
+        # an ipa reused without being built again belongs to the current release too
+        with self.lock:
+            for buildName, artifact in self.artifacts.iteritems():
+                if artifact['exportPath'] == os.path.abspath(exportPath):
+                    artifact['lastUsedTime'] = time.time()
+                    self.usedBuildNames.add(buildName)
+            self.save()
+            
+    def evict(self):
+        with self.lock:
+            if self.keptPerProfile:
+                buildNamesOfProfiles = {}
+                for buildName, artifact in self.artifacts.iteritems():
+                    if artifact['profile']:
+                        buildNamesOfProfiles.setdefault(artifact['profile'], []).append(buildName)
+                for buildNames in buildNamesOfProfiles.itervalues():
+                    buildNames.sort(key = lambda buildName: self.artifacts[buildName]['createdTime'], reverse = True)
+                    for buildName in buildNames[self.keptPerProfile:]:
+                        if buildName not in self.usedBuildNames:
+                            self.remove(buildName)
+            if self.sizeLimit:
+                candidates = sorted([buildName for buildName in self.artifacts if buildName not in self.usedBuildNames],
+                                    key = lambda buildName: self.artifacts[buildName]['lastUsedTime'])
+                while candidates and self.totalSize() > self.sizeLimit:
+                    self.remove(candidates.pop(0))
+            self.save()
+            
+    def totalSize(self):
+        # a shared archive takes up space only once
+        sizes = {}
+        for artifact in self.artifacts.itervalues():
+            sizes[artifact['archivePath']] = artifact['archiveSize']
+            sizes[artifact['exportPath']] = artifact['exportSize']
+        return sum(sizes.itervalues())
+        
+    def remove(self, buildName):
+        artifact = self.artifacts.pop(buildName)
+        for key in ['archivePath', 'exportPath']:
+            path = artifact[key]
+            if not path or any(other[key] == path for other in self.artifacts.itervalues()):
+                continue
+            print 'remove %s' % path
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        if callable(self.onEvicted):
+            self.onEvicted(artifact)
+            
+    def save(self):
+        saveJSONFile(self.indexPath, self.artifacts)
+        
+def measurePath(path):
+    if not path or not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for directory, folderNames, fileNames in os.walk(path):
+        for fileName in fileNames:
+            size += os.lstat(os.path.join(directory, fileName)).st_size
+    return size
+    
+def hashFile(filePath, hashType, blockSize = 1 << 20):
+    fileHash = hashType()
+    with open(filePath, 'rb') as fileHandle:
+        while True:
+            block = fileHandle.read(blockSize)
+            if not block:
+                break
+            fileHash.update(block)
+    return fileHash.hexdigest()
+    
+class ReleaseJournal(object):
+    # records what every stage of a release has done so that a failed release can be resumed
+    def __init__(self, journalPath):
+        self.journalPath = journalPath
+        self.lock = threading.Lock()
+        self.stages = {}
+        
+    def start(self):
+        with self.lock:
+            self.stages = {'startTime': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self.save()
+            
+    def resume(self):
+        # returns False if the last release has finished and there is nothing to resume
+        stages = loadJSONFile(self.journalPath, {})
+        if not stages or stages.get('finished'):
+            return False
+        with self.lock:
+            self.stages = stages
+        return True
+        
+    def isDone(self, stage):
+        return bool(self.stages.get(stage))
+        
+    def markDone(self, stage):
+        with self.lock:
+            self.stages[stage] = True
+            self.save()
+            
+    def getProfile(self, profileName):
+        return self.stages.get('profiles', {}).get(profileName)
+        
+    def updateProfile(self, profileName, **values):
+        with self.lock:
+            self.stages.setdefault('profiles', {}).setdefault(profileName, {}).update(values)
+            self.save()
+            
+    def getUpload(self, destination, filePath):
+        return self.stages.get('uploads', {}).get(destination, {}).get(filePath)
+        
+    def recordUpload(self, destination, filePath, result):
+        with self.lock:
+            self.stages.setdefault('uploads', {}).setdefault(destination, {})[filePath] = result
+            self.save()
+            
+    def save(self):
+        saveJSONFile(self.journalPath, self.stages)
+        
+class ArtifactReader(object):
+    # maps a file once and hashes whatever the destinations read from it as they go
+    def __init__(self, filePath, digests = None):
+        self.filePath = filePath
+        fileStat = os.stat(filePath)
+        self.fileKey = (filePath, fileStat.st_size, fileStat.st_mtime)
+        self.size = fileStat.st_size
+        self.lock = threading.Lock()
+        self.digests = digests
+        self.hashers = {'md5': hashlib.md5(), 'sha256': hashlib.sha256()}
+        self.hashedSize = 0
+        self.fileMap = None
+        # mmap refuses empty files
+        if self.size:
+            with open(filePath, 'rb') as fileHandle:
+                self.fileMap = mmap.mmap(fileHandle.fileno(), 0, access = mmap.ACCESS_READ)
+        
+    def read(self, offset, size):
+        data = self.fileMap[offset:offset + size] if self.fileMap else ''
+        # only the data that continues the hashed prefix can be hashed right away
+        if not self.digests and offset <= self.hashedSize < offset + len(data):
+            with self.lock:
+                if offset <= self.hashedSize < offset + len(data):
+                    self.hash(data[self.hashedSize - offset:])
+        return data
+        
+    def hash(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.hashedSize += len(data)
+        if self.hashedSize >= self.size:
+            self.digests = dict([(name, hasher.hexdigest()) for name, hasher in self.hashers.items()])
+            
+    def getDigests(self):
+        with self.lock:
+            if not self.digests:
+                with tracer.span('hashFile', file = os.path.split(self.filePath)[1]) as span:
+                    blockSize = 1 << 20
+                    span.addBytes(self.size - self.hashedSize)
+                    while self.hashedSize < self.size:
+                        self.hash(self.fileMap[self.hashedSize:self.hashedSize + blockSize])
+                    if not self.size:
+                        self.hash('')
+            return self.digests
+            
+    def close(self):
+        if self.fileMap:
+            self.fileMap.close()
+        self.fileMap = None
+        
+class ArtifactStream(object):
+    # a file object over a shared reader, for the uploaders that want one
+    def __init__(self, pool, reader, throttle = None):
+        self.pool = pool
+        self.reader = reader
+        self.position = 0
+        # called with the number of bytes read, and may hold the reader back to limit the rate of an upload
+        self.throttle = throttle
+        
+    def read(self, size = -1):
+        if size < 0:
+            size = self.reader.size - self.position
+        data = self.reader.read(self.position, size)
+        self.position += len(data)
+        if self.throttle and data:
+            self.throttle(len(data))
+        return data
+        
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.reader.size
+        self.position = max(offset, 0)
+        
+    def tell(self):
+        return self.position
+        
+    def close(self):
+        if self.reader:
+            self.pool.release(self.reader)
+        self.reader = None
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, excType, excValue, excTraceback):
+        self.close()
+        
+class ArtifactReaderPool(object):
+    # every destination and every digest of a file share one reader while any of them has it open
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.userCounts = {}
+        # digests outlive the readers, keyed by path, size and modification time
+        self.digests = {}
+        
+    def acquire(self, filePath):
+        filePath = os.path.abspath(filePath)
+        with self.lock:
+            reader = self.readers.get(filePath)
+            if not reader:
+                fileStat = os.stat(filePath)
+                digests = self.digests.get((filePath, fileStat.st_size, fileStat.st_mtime))
+                reader = self.readers[filePath] = ArtifactReader(filePath, digests)
+                self.userCounts[filePath] = 0
+            self.userCounts[filePath] += 1
+            return reader
+            
+    def release(self, reader):
+        with self.lock:
+            self.userCounts[reader.filePath] -= 1
+            if self.userCounts[reader.filePath] > 0:
+                return
+            del self.userCounts[reader.filePath]
+            del self.readers[reader.filePath]
+            if reader.digests:
+                self.digests[reader.fileKey] = reader.digests
+            reader.close()
+            
+    def open(self, filePath, throttle = None):
+        return ArtifactStream(self, self.acquire(filePath), throttle)
+        
+    def getDigests(self, filePath):
+        reader = self.acquire(filePath)
+        try:
+            return reader.getDigests()
+        finally:
+            self.release(reader)
+            
+artifactReaders = ArtifactReaderPool()
+    
+def runInParallel(function, items, workerCount, stopOnFailure = True):
+    # results keep the order of items; a failed or skipped item leaves None in its slot
+    results = [None] * len(items)
+    pendingIndices = Queue.Queue()
+    for index in xrange(len(items)):
+        pendingIndices.put(index)
+    failed = threading.Event()
+    
+    def work():
+        while not (stopOnFailure and failed.is_set()):
+            try:
+                index = pendingIndices.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = function(items[index])
+            except:
+                excInfo = sys.exc_info()
+                traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+            if not results[index]:
+                failed.set()
+                
+    workers = [threading.Thread(target = work) for i in xrange(min(max(workerCount, 1), len(items)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        # join with a timeout so that Ctrl-C still reaches the main thread
+        while worker.is_alive():
+            worker.join(0.5)
+    return results, not failed.is_set()
+    
+class ResourceSlots(object):
+    # a semaphore whose capacity can change while it is held; None is unlimited
+    def __init__(self, name, capacity = None):
+        self.name = name
+        self.capacity = capacity
+        self.used = 0
+        self.condition = threading.Condition()
+        # waiters in the order they are let in: by priority, then by arrival
+        self.waiters = []
+        self.arrivals = itertools.count()
+        
+    def setCapacity(self, capacity):
+        with self.condition:
+            self.capacity = capacity
+            self.condition.notify_all()
+            
+    def acquire(self, priority = ()):
+        with self.condition:
+            ticket = (priority, next(self.arrivals))
+            heapq.heappush(self.waiters, ticket)
+            while (self.capacity is not None and self.used >= self.capacity) or self.waiters[0] != ticket:
+                self.condition.wait(0.5)
+            heapq.heappop(self.waiters)
+            self.used += 1
+            # the next waiter may fit as well
+            self.condition.notify_all()
+            
+    def release(self):
+        with self.condition:
+            self.used -= 1
+            self.condition.notify_all()
+            
+    @contextlib.contextmanager
+    def slot(self, priority = (), **args):
+        if self.waiters or (self.capacity is not None and self.used >= self.capacity):
+            # only a wait that actually happens shows up in the trace
+            with tracer.span('wait for %s' % self.name, **args):
+                self.acquire(priority)
+        else:
+            self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+            
+class TokenBucket(object):
+    # lets rate units through per second on average and up to burst units at once
+    def __init__(self, rate, burst = None):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self.tokens = self.burst
+        self.updateTime = time.time()
+        self.lock = threading.Lock()
+        
+    def consume(self, amount):
+        # the tokens may run into debt, which the callers pay off by waiting in the order they came
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updateTime) * self.rate)
+            self.updateTime = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+            
+class ThroughputEstimator(object):
+    # the rate of the bytes recorded over successive intervals
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.intervalStart = time.time()
+        self.intervalBytes = 0
+        
+    def record(self, byteCount):
+        # returns the rate of an interval as it closes, and None otherwise
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.intervalStart
+            if elapsed > self.interval * 3:
+                # nothing was recorded for a while, which says nothing about the rate
+                self.intervalStart = now
+                self.intervalBytes = byteCount
+                return None
+            self.intervalBytes += byteCount
+            if elapsed < self.interval:
+                return None
+            rate = self.intervalBytes / elapsed
+            self.intervalStart = now
+            self.intervalBytes = 0
+            return rate
+            
+def measurePhysicalMemory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+        
+class ResourceScheduler(object):
+    # shared by every release in the process, so that releases run side by side neither
+    # oversubscribe the machine and the uplink nor leave them idle
+    uploadBalanceInterval = 3
     
+    def __init__(self):
+        self.buildSlots = ResourceSlots('build slot')
+        self.uploadSlots = ResourceSlots('upload slot')
+        self.uploadBuckets = {}
+        self.overallUploadBucket = None
+        self.uploadThroughput = ThroughputEstimator(ResourceScheduler.uploadBalanceInterval)
+        self.balanceLock = threading.Lock()
+        self.maximumUploads = None
+        # the throughput measured with every number of uploads at a time
+        self.uploadRates = {}
+        self.steadyIntervals = 0
+        
+    def configure(self, buildConfig):
+        buildLimit = buildConfig.get('MAX_CONCURRENT_BUILDS', 0)
+        if not buildLimit:
+            # every xcodebuild is given enough cores and memory of its own
+            buildLimit = multiprocessing.cpu_count() // max(buildConfig.get('CORES_PER_BUILD', 2), 1)
+            physicalMemory = measurePhysicalMemory()
+            if physicalMemory:
+                buildLimit = min(buildLimit, int(physicalMemory // (buildConfig.get('MEMORY_PER_BUILD_GB', 4) * (1 << 30))))
+        self.buildSlots.setCapacity(max(buildLimit, 1))
+        bandwidth = buildConfig.get('UPLOAD_BANDWIDTH_MBPS', 0)
+        uploadLimit = None
+        if bandwidth:
+            # as many uploads as it takes for their usual speeds to fill the bandwidth
+            uploadLimit = max(int(bandwidth // (buildConfig.get('BANDWIDTH_PER_UPLOAD_MBPS') or bandwidth)), 1)
+        self.uploadSlots.setCapacity(uploadLimit)
+        self.maximumUploads = uploadLimit
+        
+        createBucket = lambda rate: TokenBucket(rate * 1048576) if rate else None
+        self.overallUploadBucket = createBucket(buildConfig.get('UPLOAD_RATE_LIMIT_MBPS', 0))
+        self.uploadBuckets = dict([(name, createBucket(destinationInfo.get('UPLOAD_RATE_LIMIT_MBPS', 0)))\
+                                   for name, destinationInfo in loadDestinations(buildConfig).items()])
+        
+    def throttleUpload(self, destination, byteCount):
+        bucket = self.uploadBuckets.get(destination)
+        if bucket:
+            bucket.consume(byteCount)
+        if self.overallUploadBucket:
+            self.overallUploadBucket.consume(byteCount)
+        rate = self.uploadThroughput.record(byteCount)
+        if rate is not None:
+            self.balanceUploads(rate)
+            
+    def balanceUploads(self, rate):
+        # looks for the fewest uploads at a time that reach the best throughput
+        if not self.maximumUploads:
+            return
+        with self.balanceLock:
+            capacity = self.uploadSlots.capacity
+            if self.uploadSlots.used < capacity and not self.uploadSlots.waiters:
+                # some slots were left unused, so the rate says nothing about their number
+                return
+            lastRate = self.uploadRates.get(capacity)
+            self.uploadRates[capacity] = rate if lastRate is None else (lastRate + rate) / 2
+            bestCapacity = max(self.uploadRates, key = self.uploadRates.get)
+            bestRate = self.uploadRates[bestCapacity]
+            if self.uploadRates[capacity] >= bestRate * 0.9:
+                # as good as the best, so see whether one upload less does as well
+                fewerRate = self.uploadRates.get(capacity - 1)
+                isWorthTrying = capacity > 1 and (fewerRate is None or fewerRate >= bestRate * 0.9)
+                newCapacity = capacity - 1 if isWorthTrying else capacity
+            else:
+                newCapacity = capacity + 1 if bestCapacity > capacity else capacity - 1
+            self.steadyIntervals = self.steadyIntervals + 1 if newCapacity == capacity else 0
+            if self.steadyIntervals >= 10:
+                # the link may have changed since, so measure again starting with one upload more
+                self.uploadRates = {}
+                self.steadyIntervals = 0
+                newCapacity = capacity + 1
+            newCapacity = min(max(newCapacity, 1), self.maximumUploads)
+            if newCapacity != capacity:
+                print 'upload %d files at a time instead of %d (%.2f MB/s)' % (newCapacity, capacity, rate / 1048576.0)
+                self.uploadSlots.setCapacity(newCapacity)
+        
+    def describe(self):
+        return '%s builds and %s uploads at a time' % (self.buildSlots.capacity or 'unlimited', self.uploadSlots.capacity or 'unlimited')
+        
+resourceScheduler = ResourceScheduler()
+
 optionGenerator = lambda name, value: '%s "%s"' % (name, value) if name and value else name or '"%s"' % value        
+
+def generateSvnAuthOptions(buildInfo):
+    if 'SVN_USER' in buildInfo and 'SVN_PASSWORD' in buildInfo:
+        return ' '.join([optionGenerator('--username', buildInfo['SVN_USER']), optionGenerator('--password', buildInfo['SVN_PASSWORD'])])
+    return ''
             
 class BaseBuilder(object):
-    def __init__(self, model, verbose):
+    def __init__(self, model, verbose, workers = 1):
         self.model = model
         self.verbose = verbose
+        self.workers = max(workers, 1)
+        # called with (index, profile, result) as soon as a profile is built
+        self.resultHandler = lambda index, profile, result: None
         
     def prepareRun(self):
         pass
@@ -156,24 +1469,75 @@ class BaseBuilder(object):
     def run(self):
         if not self.prepareRun():
             return
+        results = self.findReusableResults()
+        if results:
+            for index, profile in enumerate(self.getProfiles()):
+                self.profileDone(index, profile, results[index])
+            return results
+        if self.workers > 1 and self.canRunProfilesInParallel():
+            results = self.runProfilesInParallel()
+        else:
+            results = self.runProfilesInSequence()
+        if results is None:
+            return
+        self.runDone()
+        return results
+        
+    def runProfilesInSequence(self):
         results = []
-        for profile in self.getProfiles():
+        for index, profile in enumerate(self.getProfiles()):
             self.prepareRunProfile(profile)
             result = self.runProfile(profile)
             if not result:
                 return
+            self.profileDone(index, profile, result)
             results.append(result)
-        self.runDone()
         return results
         
+    def runProfilesInParallel(self):
+        # profiles are prepared in order so that build numbers are assigned as in a serial run
+        forks = []
+        for index, profile in enumerate(self.getProfiles()):
+            self.prepareRunProfile(profile)
+            forks.append((index, profile, self.forkProfile(profile)))
+            
+        def runFork(fork):
+            result = fork[2].runProfile(fork[1])
+            if result:
+                self.profileDone(fork[0], fork[1], result)
+            return result
+        results, succeeded = runInParallel(runFork, forks, self.workers)
+        if not succeeded:
+            return
+        return results
+        
+    def canRunProfilesInParallel(self):
+        return True
+        
+    def profileDone(self, index, profile, result):
+        self.resultHandler(index, profile, result)
+        
+    def forkProfile(self, profile):
+        # a fork owns a copy of the model so it can run beside other profiles
+        fork = copy.copy(self)
+        fork.model = copy.copy(self.model)
+        return fork
+        
+    def findReusableResults(self):
+        # the results of an earlier run that can stand in for building every profile again
+        pass
+        
     def runDone(self):
         pass
         
     def prepareRunProfile(self, profile):
-        self.model.nextBuildPathInfo(self.getCurrentAppBuild(), profile)
+        self.assignBuildPathInfo(profile)
         if self.verbose:
             print 'Build %s' % unicode(self.model)
         
+    def assignBuildPathInfo(self, profile):
+        self.model.nextBuildPathInfo(self.getCurrentAppBuild(), profile)
+        
     def runProfile(self, profile):
         pass
         
@@ -184,74 +1548,251 @@ class BaseBuilder(object):
         pass
         
 class IpaBuilder(BaseBuilder):
-    def __init__(self, model, verbose):
-        super(IpaBuilder, self).__init__(model, verbose)
+    def __init__(self, model, verbose, workers = 1, commandRunner = commandRunner):
+        super(IpaBuilder, self).__init__(model, verbose, workers)
         
-        self.plistEditor = None
+        self.commandRunner = commandRunner
+        self.plistDocument = None
+        self.buildCache = None
+        self.forcesRebuild = False
+        self.cleansBeforeArchive = True
+        self.sourceFingerprint = None
+        self.journal = None
+        self.artifactStore = None
+        self.versionControl = createVersionControl(model.buildInfo, commandRunner)
+        self.releasedStatePath = os.path.join(model.outputFolder, 'releasedState.json')
+        self.releasedState = loadJSONFile(self.releasedStatePath, None)
+        self.reusableResults = None
+        self.committed = False
+        self.hasUnreleasedChanges = True
         
     def prepareRun(self):
-        if not issueCommand('svn update'):
-            return False
+        resumesUpdate = self.journal and self.journal.isDone('update')
+        status = self.versionControl.getStatus(not resumesUpdate)
+        if resumesUpdate:
+            # updating now could change what the profiles already built were built from
+            print 'skip %s update, which the resumed release has done' % self.versionControl.name
+        elif status and status.isCurrent:
+            print 'skip %s update, the working copy is already current' % self.versionControl.name
+        else:
+            with tracer.span('%s update' % self.versionControl.name):
+                if not self.versionControl.update():
+                    return False
+        if self.journal and not resumesUpdate:
+            self.journal.markDone('update')
+            
+        self.hasUnreleasedChanges = not status or self.findUnreleasedChanges(status)
+        self.reusableResults = self.findReleasedIpas(status)
+        if self.reusableResults:
+            print 'nothing has changed since revision %s was released. Reuse %s' % (self.releasedState['revision'], str(self.reusableResults))
+            return True
     
         # version should be fixed
-        self.plistEditor = PlistEditor(self.model['INFO_PLIST_PATH'])
-        self.plistEditor.replaceSimpleValue('CFBundleShortVersionString', self.model['APP_VERSION'])
-        self.plistEditor.commit()
+        self.plistDocument = PlistDocument(self.model.resolvePath(self.model['INFO_PLIST_PATH']))
+        self.plistDocument.setValue('CFBundleShortVersionString', self.model['APP_VERSION'])
+        self.plistDocument.save()
+        
+        if self.buildCache:
+            # the plist differs for every profile, so it is fingerprinted per profile instead
+            self.sourceFingerprint = self.buildCache.fingerprintSourceTree(self.model.resolvePath('.'), self.getUnreleasedPaths())
         return True
         
-    def runDone(self):
-        # commit the info plist
-        logMessage = self.model['COMMIT_LOG_TEMPLATE'].format(**self.model.buildInfo)
-        commitOptions = []
-        commitOptions.append(optionGenerator('-m', logMessage))
-        if 'SVN_USER' in self.model and 'SVN_PASSWORD' in self.model:
-            commitOptions.append(optionGenerator('--username', self.model['SVN_USER']))
-            commitOptions.append(optionGenerator('--password', self.model['SVN_PASSWORD']))
-        commitCommand = 'svn commit %s "%s"' % (' '.join(commitOptions), self.model['INFO_PLIST_PATH'])
-        issueCommand(commitCommand)
+    def getUnreleasedPaths(self):
+        # the paths the release changes by itself, which say nothing about whether the app has changed
+        return [self.model.resolvePath(self.model['INFO_PLIST_PATH']), self.model.resolvePath(self.model['THIS_FILE_FOLDER']), self.model.outputFolder]
         
-    def prepareRunProfile(self, profile):
-        self.plistEditor = PlistEditor(self.model['INFO_PLIST_PATH'])
+    def findReleasedIpas(self, status):
+        if self.forcesRebuild or not status:
+            return None
+        if self.journal and self.journal.stages.get('profiles'):
+            # the resumed release has built profiles of its own
+            return None
+        if not self.releasedState or self.releasedState.get('configFingerprint') != self.fingerprintConfig():
+            return None
+        if self.hasUnreleasedChanges:
+            return None
+        if self.versionControl.getRevision() != self.releasedState['revision']:
+            return None
+        ipas = [self.releasedState['ipas'].get(self.model.getProfileName(profile)) for profile in self.getProfiles()]
+        if not all(ipas) or not all(map(os.path.isfile, ipas)):
+            return None
+        if self.artifactStore:
+            for ipa in ipas:
+                self.artifactStore.touch(ipa)
+        return ipas
         
-        super(IpaBuilder, self).prepareRunProfile(profile)
+    def findUnreleasedChanges(self, status):
+        # local changes that are not in any revision, so the ipas built from them cannot be told apart by revision
+        unreleasedPaths = self.getUnreleasedPaths()
+        return [modifiedPath for modifiedPath in status.modifiedPaths if not any(isSameOrInsidePath(modifiedPath, path) for path in unreleasedPaths)]
         
-    def runProfile(self, profile):
-        self.updatePlist(self.plistEditor, profile)
-        if not self.issueClean():
-            return
-        if not self.issueArchive(profile):
-            return
-        return self.issueExport(profile)
+    def findReusableResults(self):
+        return self.reusableResults
         
-    def getProfiles(self):
-        return self.model['BUILD_PROFILES']
+    def fingerprintConfig(self):
+        # what the ipas are built from besides the working copy
+        keys = ['FRIENDLY_APP_NAME', 'APP_VERSION', 'INFO_PLIST_PATH', 'INCREMENT_BUILD_NUMBER', 'BUILD_PROFILES']
+        return hashlib.sha1(json.dumps([self.model.buildInfo.get(key) for key in keys], sort_keys = True)).hexdigest()
         
-    def getCurrentAppBuild(self):
-        return self.plistEditor.readSimpleValue('CFBundleVersion')
-    
-    def updatePlist(self, plistEditor, profile):
-        plistEditor.replaceSimpleValue('CFBundleIdentifier', profile['bundleIdentifier'])
-        if self.model.buildNumber:
-            plistEditor.replaceSimpleValue('CFBundleVersion', self.model.buildNumber)
-        self.plistEditor.commit()
+    def run(self):
+        results = super(IpaBuilder, self).run()
+        if results and not self.reusableResults and self.committed and not self.hasUnreleasedChanges:
+            # the next run can skip the build as long as nothing changes
+            ipas = dict([(self.model.getProfileName(profile), os.path.abspath(ipa)) for profile, ipa in zip(self.getProfiles(), results)])
+            self.releasedState = {'revision': self.versionControl.getRevision(), 'configFingerprint': self.fingerprintConfig(), 'ipas': ipas}
+            saveJSONFile(self.releasedStatePath, self.releasedState)
+        return results
         
+    def runDone(self):
+        # commit the info plist
+        self.committed = self.journal and self.journal.isDone('commit')
+        if self.committed:
+            return
+        infoPlistPath = self.model.resolvePath(self.model['INFO_PLIST_PATH'])
+        if not self.versionControl.hasLocalChanges(infoPlistPath):
+            print 'skip %s commit, %s has not changed' % (self.versionControl.name, self.model['INFO_PLIST_PATH'])
+            committed = True
+        else:
+            logMessage = self.model['COMMIT_LOG_TEMPLATE'].format(**self.model.buildInfo)
+            with tracer.span('%s commit' % self.versionControl.name):
+                committed = self.versionControl.commit(logMessage, infoPlistPath)
+        self.committed = committed
+        if committed and self.journal:
+            self.journal.markDone('commit')
+        
+    def assignBuildPathInfo(self, profile):
+        profileName = self.model.getProfileName(profile)
+        journaledProfile = self.journal.getProfile(profileName) if self.journal else None
+        if journaledProfile:
+            # keep the build number and name given by the resumed release instead of taking a new one
+            self.model.setBuildPathInfo(journaledProfile['buildNumber'], journaledProfile['buildName'])
+            return
+        super(IpaBuilder, self).assignBuildPathInfo(profile)
+        if self.journal:
+            self.journal.updateProfile(profileName, buildNumber = self.model.buildNumber, buildName = self.model.buildName,
+                                       archivePath = os.path.abspath(self.model.archivePath), exportPath = os.path.abspath(self.model.exportPath))
+        
+    def runProfile(self, profile):
+        self.updatePlist(self.plistDocument, profile)
+        profileName = self.model.getProfileName(profile)
+        journaledProfile = (self.journal.getProfile(profileName) if self.journal else None) or {}
+        if journaledProfile.get('exported') and os.path.isfile(self.model.exportPath):
+            print 'reuse %s exported by the resumed release' % self.model.exportPath
+            self.storeArtifacts(profile)
+            return self.model.exportPath
+        fingerprint = self.fingerprintProfile(profile)
+        cachedArchivePath = self.buildCache.lookup(fingerprint) if fingerprint and not self.forcesRebuild else None
+        if not cachedArchivePath and journaledProfile.get('archived') and os.path.isdir(self.model.archivePath):
+            cachedArchivePath = self.model.archivePath
+        if cachedArchivePath:
+            # nothing the archive is built from has changed, so only export it again
+            print 'reuse %s' % cachedArchivePath
+            self.model.archivePath = cachedArchivePath
+        else:
+            if (self.cleansBeforeArchive or self.forcesRebuild) and not self.issueClean():
+                return
+            if self.buildCache:
+                self.buildCache.forget(self.model.archivePath)
+            if not self.issueArchive(profile):
+                return
+            if fingerprint:
+                self.buildCache.store(fingerprint, self.model.archivePath)
+            if self.journal:
+                self.journal.updateProfile(profileName, archived = True)
+        exportPath = self.issueExport(profile)
+        if exportPath:
+            self.storeArtifacts(profile)
+            if self.journal:
+                self.journal.updateProfile(profileName, exported = True)
+        return exportPath
+        
+    def storeArtifacts(self, profile):
+        if self.artifactStore:
+            self.artifactStore.register(self.model.getProfileName(profile), self.model.buildNumber, self.model.buildName,
+                                        self.model.archivePath, self.model.exportPath)
+        
+    def fingerprintProfile(self, profile):
+        if not self.sourceFingerprint:
+            return None
+        profileHash = hashlib.sha1(self.sourceFingerprint)
+        for key in ['scheme', 'bundleIdentifier', 'provisioningProfile', 'signingIdentity']:
+            profileHash.update('%s\0%s\0' % (key, (profile.get(key) or u'').encode('utf-8')))
+        profileHash.update(self.plistDocument.render())
+        return profileHash.hexdigest()
+        
+    def canRunProfilesInParallel(self):
+        # a fork hands its Info.plist to xcodebuild as INFOPLIST_FILE, which applies to every target of the scheme,
+        # so a scheme that also builds extensions or frameworks would give them the Info.plist of the app
+        for scheme in sorted(set([profile['scheme'] for profile in self.getProfiles()])):
+            output = self.commandRunner.readOutput('xcodebuild -scheme "%s" -showBuildSettings' % scheme)
+            if output is None:
+                print 'cannot list the targets of scheme %s. Build the profiles one at a time' % scheme
+                return False
+            targets = []
+            for line in output.splitlines():
+                match = re.match(r'^Build settings for action \w+ and target "?(.+?)"?:$', line.strip())
+                if match:
+                    targets.append([match.group(1), False])
+                elif targets and re.match(r'^INFOPLIST_FILE = \S', line.strip()):
+                    targets[-1][1] = True
+            plistTargets = [target for target, hasInfoPlist in targets if hasInfoPlist]
+            if len(plistTargets) > 1:
+                print 'scheme %s builds %s, which cannot share one Info.plist. Build the profiles one at a time' % (scheme, ', '.join(plistTargets))
+                return False
+        return True
+        
+    def forkProfile(self, profile):
+        # the shared plist still receives the edits in profile order, so the next profile reads
+        # the right build number and runDone commits what a serial run would have committed
+        self.updatePlist(self.plistDocument, profile)
+        fork = super(IpaBuilder, self).forkProfile(profile)
+        fork.model.isolateBuildPaths(profile)
+        fork.plistDocument = self.plistDocument.clone(fork.model.infoPlistPath)
+        return fork
+        
+    def getProfiles(self):
+        return self.model['BUILD_PROFILES']
+        
+    def getCurrentAppBuild(self):
+        return self.plistDocument.getValue('CFBundleVersion')
+    
+    def updatePlist(self, plistDocument, profile):
+        plistDocument.setValue('CFBundleIdentifier', profile['bundleIdentifier'])
+        if self.model.buildNumber:
+            plistDocument.setValue('CFBundleVersion', self.model.buildNumber)
+        plistDocument.save()
+        
+    @traced('issueClean', lambda self, *args: {'build': self.model.buildName})
     def issueClean(self):
+        if self.model.derivedDataPath:
+            # xcodebuild clean would wipe the build folder shared with the other profiles
+            if os.path.exists(self.model.derivedDataPath):
+                shutil.rmtree(self.model.derivedDataPath)
+            return True
         cleanCommand = 'xcodebuild clean'
-        return issueCommand(cleanCommand)
+        with resourceScheduler.buildSlots.slot(build = self.model.buildName):
+            return self.commandRunner.issue(cleanCommand, label = self.model.buildName)
         
+    @traced('issueArchive', lambda self, *args: {'build': self.model.buildName})
     def issueArchive(self, profile):
         scheme = profile['scheme']
         archiveCommand = 'xcodebuild -scheme "%s" archive -archivePath "%s"' % (scheme, self.model.archivePath)
+        if self.model.derivedDataPath:
+            archiveCommand += ' %s' % optionGenerator('-derivedDataPath', self.model.derivedDataPath)
+        if self.model.infoPlistPath:
+            archiveCommand += ' INFOPLIST_FILE="%s"' % self.model.infoPlistPath
         if os.path.exists(self.model.archivePath):
             shutil.rmtree(self.model.archivePath)
-        return issueCommand(archiveCommand)
+        with resourceScheduler.buildSlots.slot(build = self.model.buildName):
+            return self.commandRunner.issue(archiveCommand, label = self.model.buildName)
         
+    @traced('issueExport', lambda self, *args: {'build': self.model.buildName})
     def issueExport(self, profile):
         exportOptions = []
         exportOptions.append(optionGenerator('-exportArchive', ''))
         optionsPlist = profile.get('exportOptionsPlist')
         if optionsPlist:
-            optionsPlist = os.path.join(self.model['THIS_FILE_FOLDER'], optionsPlist)
+            optionsPlist = os.path.join(self.model.resolvePath(self.model['THIS_FILE_FOLDER']), optionsPlist)
             exportOptions.append(optionGenerator('-exportOptionsPlist', optionsPlist))
         else:
             exportOptions.append(optionGenerator('-exportFormat', 'ipa'))
@@ -268,20 +1809,24 @@ class IpaBuilder(BaseBuilder):
                 shutil.rmtree(self.model.exportPath)
             else:
                 os.remove(self.model.exportPath)
-        if not issueCommand(exportCommand):
+        with resourceScheduler.buildSlots.slot(build = self.model.buildName):
+            exported = self.commandRunner.issue(exportCommand, label = self.model.buildName)
+        if not exported:
             return
         if os.path.isdir(self.model.exportPath):
             self.moveProduct()
         return self.model.exportPath
 
+    @traced('moveProduct', lambda self, *args: {'build': self.model.buildName})
     def moveProduct(self):
         for fileName in os.listdir(self.model.exportPath):
             if os.path.splitext(fileName)[1].lower() != '.ipa' or not os.path.isfile(os.path.join(self.model.exportPath, fileName)):
                 continue
-            parentDirectory = os.path.split(self.model.exportPath)[0]
-            shutil.copy2(os.path.join(self.model.exportPath, fileName), parentDirectory)
+            # profiles built at the same time export ipas of the same name, so stage it under the build name
+            temporaryPath = self.model.exportPath + '.tmp'
+            os.rename(os.path.join(self.model.exportPath, fileName), temporaryPath)
             shutil.rmtree(self.model.exportPath)
-            os.rename(os.path.join(parentDirectory, fileName), self.model.exportPath)
+            os.rename(temporaryPath, self.model.exportPath)
             return
     
 def printProgress(progress, ongoing):
@@ -307,29 +1852,185 @@ def splitPathIntoComponents(path):
             
     return components
     
+def escapeDriveQueryValue(value):
+    return value.replace('\\', '\\\\').replace('\'', '\\\'')
+    
+class DriveFolderCache(object):
+    # remembers the ID of every folder on the way to GOOGLE_DRIVE_PATH across runs
+    def __init__(self, cachePath):
+        self.cachePath = cachePath
+        self.lock = threading.RLock()
+        self.folderIDs = loadJSONFile(cachePath, {})
+        
+    @staticmethod
+    def keyOfComponents(components):
+        return '/'.join(components)
+        
+    def get(self, components):
+        return self.folderIDs.get(DriveFolderCache.keyOfComponents(components))
+        
+    def set(self, components, folderID):
+        with self.lock:
+            self.folderIDs[DriveFolderCache.keyOfComponents(components)] = folderID
+        
+    def forget(self, components):
+        # the folders below a stale one are stale as well
+        key = DriveFolderCache.keyOfComponents(components)
+        with self.lock:
+            for cachedKey in self.folderIDs.keys():
+                if cachedKey == key or cachedKey.startswith(key + '/'):
+                    del self.folderIDs[cachedKey]
+            self.save()
+                
+    def save(self):
+        with self.lock:
+            saveJSONFile(self.cachePath, self.folderIDs)
+        
+class DriveUploadJournal(object):
+    # remembers the resumable session of every unfinished upload so that a later run can continue it
+    def __init__(self, journalPath):
+        self.journalPath = journalPath
+        self.lock = threading.Lock()
+        self.sessions = loadJSONFile(journalPath, {})
+        
+    def lookup(self, filePath, folderID):
+        fileStat = os.stat(filePath)
+        with self.lock:
+            session = self.sessions.get(os.path.abspath(filePath))
+        # a rebuilt file cannot continue the upload of the old one
+        if session and session['folderID'] == folderID and session['size'] == fileStat.st_size and session['mtime'] == fileStat.st_mtime:
+            # httplib cannot send a unicode URI along with a binary body
+            return str(session['uri'])
+        return None
+        
+    def record(self, filePath, folderID, sessionURI):
+        fileStat = os.stat(filePath)
+        with self.lock:
+            self.sessions[os.path.abspath(filePath)] = {
+                'uri': sessionURI,
+                'folderID': folderID,
+                'size': fileStat.st_size,
+                'mtime': fileStat.st_mtime
+            }
+            saveJSONFile(self.journalPath, self.sessions)
+            
+    def forget(self, filePath):
+        with self.lock:
+            if self.sessions.pop(os.path.abspath(filePath), None):
+                saveJSONFile(self.journalPath, self.sessions)
+                
+class ChunkSizeTuner(object):
+    # sizes the chunks of an upload so that each takes about targetDuration at the measured throughput
+    granularity = 256 * 1024
+    
+    def __init__(self, chunkSize = 1 << 20, maximumSize = 64 << 20, targetDuration = 5.0):
+        self.maximumSize = maximumSize
+        self.targetDuration = targetDuration
+        self.chunkSize = self.roundSize(chunkSize)
+        self.throughput = None
+        
+    def roundSize(self, size):
+        # the server only takes chunks in multiples of 256 KB
+        return min(max(size // ChunkSizeTuner.granularity, 1) * ChunkSizeTuner.granularity, self.maximumSize)
+        
+    def update(self, byteCount, elapsedTime):
+        throughput = byteCount / max(elapsedTime, 0.001)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * throughput
+        self.chunkSize = self.roundSize(int(self.throughput * self.targetDuration))
+        
 class GoogleDriveManager(object):
-    def __init__(self):
+    folderMimeType = 'application/vnd.google-apps.folder'
+    # HttpError is imported on demand, so it is added where the errors are caught
+    transientErrors = (socket.error, httplib.HTTPException)
+    transientStatuses = (429, 500, 502, 503, 504)
+    rateLimitReasons = ('rateLimitExceeded', 'userRateLimitExceeded')
+    maximumRetryDelay = 30
+    # Drive takes no more than 100 calls in a batch
+    batchSizeLimit = 100
+    
+    def __init__(self, discoveryServiceUrl = None, folderCache = None, uploadJournal = None, chunkSize = 1 << 20, retries = 5, batchWorkers = 1):
+        importGoogleAPIClient()
         self.service = None
+        self.credentials = None
+        self.folderCache = folderCache
+        self.uploadJournal = uploadJournal
+        self.chunkSizeTuner = ChunkSizeTuner(chunkSize)
+        self.retries = retries
+        self.batchWorkers = batchWorkers
+        self.batchConnections = threading.local()
         self.http = httplib2.Http()
+        # 308 means an incomplete upload here, not a redirect
+        if hasattr(self.http, 'redirect_codes'):
+            self.http.redirect_codes = self.http.redirect_codes - frozenset([308])
+        self.discoveryServiceUrl = discoveryServiceUrl
+        # the limits on the rate of the uploads are those of this destination
+        self.destinationName = 'Google Drive'
         
-    def authorize(self, credentials):
+    def authorize(self, credentials, discoveryDocument = None):
+        self.credentials = credentials
         self.http = credentials.authorize(self.http)
-        self.service = build('drive', 'v2', http=self.http)
+        if discoveryDocument:
+            self.service = apiclient.discovery.build_from_document(discoveryDocument, http=self.http)
+        elif self.discoveryServiceUrl:
+            self.service = apiclient.discovery.build('drive', 'v2', http=self.http, discoveryServiceUrl=self.discoveryServiceUrl)
+        else:
+            self.service = apiclient.discovery.build('drive', 'v2', http=self.http)
         
+    @traced('makeDirectory')
     def makeDirectory(self, directory):
-        components = splitPathIntoComponents(directory)
-        folderID = None
+        components = [component for component in splitPathIntoComponents(directory) if component]
+        folderID, resolvedCount = self.findCachedFolder(components)
+        if resolvedCount < len(components):
+            folderID = self.resolveFolders(components, folderID, resolvedCount)
+        return folderID
+        
+    def findCachedFolder(self, components):
+        if not self.folderCache:
+            return None, 0
+        # one cheap request checks the deepest cached folder; its ancestors need no check
+        for count in xrange(len(components), 0, -1):
+            cachedID = self.folderCache.get(components[:count])
+            if not cachedID:
+                continue
+            if self.isFolder(cachedID, components[count - 1]):
+                return cachedID, count
+            self.folderCache.forget(components[:count])
+        return None, 0
+        
+    def isFolder(self, folderID, title):
+        try:
+            folder = self.service.files().get(fileId = folderID, fields = 'id,title,mimeType,labels/trashed').execute()
+        except apiclient.errors.HttpError as error:
+            if error.resp.status == 404:
+                return False
+            raise
+        return folder['mimeType'] == GoogleDriveManager.folderMimeType and folder['title'] == title and not folder.get('labels', {}).get('trashed')
+        
+    def resolveFolders(self, components, folderID, resolvedCount):
+        # fetch every candidate for the uncached components at once instead of one request per level
+        titles = ' or '.join(['title=\'%s\'' % escapeDriveQueryValue(component) for component in set(components[resolvedCount:])])
+        query = 'mimeType=\'%s\' and trashed=false and (%s)' % (GoogleDriveManager.folderMimeType, titles)
+        candidates = self.listFiles(query, 'nextPageToken,items(id,title,parents(id,isRoot))')
+        # folders in the root come first, as a top level component may have namesakes elsewhere
+        candidates.sort(key = lambda candidate: not any(parent.get('isRoot') for parent in candidate.get('parents', [])))
         folderCreated = False
-        for component in components:
+        for index in xrange(resolvedCount, len(components)):
+            component = components[index]
+            matchedFolder = None
             if not folderCreated:
-                if folderID:
-                    queriedFolder = self.service.children().list(folderId = folderID, q = 'mimeType=\'application/vnd.google-apps.folder\' and title=\'%s\'' % component).execute()
-                else:
-                    queriedFolder = self.service.files().list(q = 'mimeType=\'application/vnd.google-apps.folder\' and title=\'%s\'' % component).execute()
-            if folderCreated or len(queriedFolder['items']) < 1:
+                for candidate in candidates:
+                    if candidate['title'] == component and (not folderID or folderID in [parent['id'] for parent in candidate.get('parents', [])]):
+                        matchedFolder = candidate
+                        break
+            if matchedFolder:
+                folderID = matchedFolder['id']
+            else:
                 body = {
                     'title': component,
-                    'mimeType': 'application/vnd.google-apps.folder'
+                    'mimeType': GoogleDriveManager.folderMimeType
                 }            
                 if folderID:
                     body['parents'] = [{
@@ -337,12 +2038,58 @@ class GoogleDriveManager(object):
                     }]
                 folderID = self.service.files().insert(body = body).execute()['id']
                 folderCreated = True
-            else:
-                folderID = queriedFolder['items'][0]['id']
+            if self.folderCache:
+                self.folderCache.set(components[:index + 1], folderID)
+        if self.folderCache:
+            self.folderCache.save()
         return folderID
         
+    def findIdenticalFile(self, filePath, folderID):
+        title = os.path.split(filePath)[1]
+        query = 'title=\'%s\' and \'%s\' in parents and trashed=false' % (escapeDriveQueryValue(title), folderID)
+        fileSize = os.path.getsize(filePath)
+        for candidate in self.listFiles(query, 'nextPageToken,items(id,fileSize,md5Checksum)'):
+            # the file is only hashed when there is something of the same size to compare with
+            if candidate.get('md5Checksum') and int(candidate.get('fileSize', -1)) == fileSize and\
+               candidate['md5Checksum'] == artifactReaders.getDigests(filePath)['md5']:
+                return candidate['id']
+        return None
+        
+    def listFiles(self, query, fields):
+        files = []
+        pageToken = None
+        while True:
+            response = self.service.files().list(q = query, fields = fields, maxResults = 1000, pageToken = pageToken).execute()
+            files.extend(response.get('items', []))
+            pageToken = response.get('nextPageToken')
+            if not pageToken:
+                return files
+                
     def insertFile(self, filePath, folderID, progressCallback = None):
-        media_body = MediaFileUpload(filePath, mimetype='application/octet-stream', resumable=True)
+        fileSize = os.path.getsize(filePath)
+        uploadedFile = None
+        with tracer.span('insertFile', file = os.path.split(filePath)[1]) as span:
+            sessionURI = self.uploadJournal.lookup(filePath, folderID) if self.uploadJournal else None
+            if sessionURI:
+                try:
+                    # ask the server how much a previous run has uploaded
+                    uploadedFile = self.uploadChunks(sessionURI, filePath, fileSize, None, progressCallback, span)
+                except apiclient.errors.HttpError as error:
+                    # the session has expired
+                    if error.resp.status not in (404, 410):
+                        raise
+            if not uploadedFile:
+                sessionURI = self.startUploadSession(filePath, folderID, fileSize)
+                if self.uploadJournal:
+                    self.uploadJournal.record(filePath, folderID, sessionURI)
+                uploadedFile = self.uploadChunks(sessionURI, filePath, fileSize, 0, progressCallback, span)
+            if self.uploadJournal:
+                self.uploadJournal.forget(filePath)
+                
+        return uploadedFile['id']
+        
+    def startUploadSession(self, filePath, folderID, fileSize):
+        media_body = apiclient.http.MediaFileUpload(filePath, mimetype='application/octet-stream', resumable=True)
         body = {
             'title': os.path.split(filePath)[1],
             'mimeType': 'application/octet-stream',
@@ -352,87 +2099,369 @@ class GoogleDriveManager(object):
             }]
         }
         
+        # the library knows the upload endpoint, but the session is driven here so that it outlives the process
         uploadRequest = self.service.files().insert(body = body, media_body = media_body)
-        uploadedFile = None
-        if callable(progressCallback):
-            while uploadedFile is None:
-                uploadStatus, uploadedFile = uploadRequest.next_chunk()
-                if uploadStatus:
-                    progressCallback(uploadStatus.progress())
-                elif uploadedFile:
-                    progressCallback(1)
-        else:
-            uploadedFile = uploadRequest.execute()
-                
-        return uploadedFile['id']
+        headers = dict(uploadRequest.headers)
+        headers['X-Upload-Content-Type'] = 'application/octet-stream'
+        headers['X-Upload-Content-Length'] = str(fileSize)
+        response, content = self.http.request(uploadRequest.uri, 'POST', body = uploadRequest.body, headers = headers)
+        if response.status != 200 or 'location' not in response:
+            raise apiclient.errors.HttpError(response, content, uri = uploadRequest.uri)
+        return response['location']
+        
+    def uploadChunks(self, sessionURI, filePath, fileSize, offset, progressCallback, span):
+        # an offset of None asks the server where to continue
+        attempt = 0
+        with artifactReaders.open(filePath, functools.partial(resourceScheduler.throttleUpload, self.destinationName)) as fileHandle:
+            while True:
+                try:
+                    if offset is None:
+                        offset, uploadedFile = self.putUploadData(sessionURI, '', 'bytes */%d' % fileSize, fileSize)
+                    else:
+                        fileHandle.seek(offset)
+                        chunk = fileHandle.read(self.chunkSizeTuner.chunkSize)
+                        contentRange = 'bytes %d-%d/%d' % (offset, offset + len(chunk) - 1, fileSize) if chunk else 'bytes */%d' % fileSize
+                        startTime = time.time()
+                        offset, uploadedFile = self.putUploadData(sessionURI, chunk, contentRange, fileSize)
+                        self.chunkSizeTuner.update(len(chunk), time.time() - startTime)
+                        span.addBytes(len(chunk))
+                    attempt = 0
+                except (apiclient.errors.HttpError,) + GoogleDriveManager.transientErrors as error:
+                    if isinstance(error, apiclient.errors.HttpError) and error.resp.status not in GoogleDriveManager.transientStatuses:
+                        raise
+                    attempt += 1
+                    if attempt > self.retries:
+                        raise
+                    time.sleep(min(2 ** (attempt - 1), GoogleDriveManager.maximumRetryDelay))
+                    # only the server knows how much of the failed chunk has arrived
+                    offset = None
+                    continue
+                    
+                if callable(progressCallback):
+                    progressCallback(float(offset) / fileSize if fileSize else 1)
+                if uploadedFile:
+                    return uploadedFile
+                    
+    def putUploadData(self, sessionURI, data, contentRange, fileSize):
+        response, content = self.http.request(sessionURI, 'PUT', body = data, headers = {
+            'Content-Range': contentRange,
+            'Content-Length': str(len(data))
+        })
+        if response.status in (200, 201):
+            return fileSize, json.loads(content)
+        if response.status == 308:
+            # Range holds the last byte received, and is missing if nothing has arrived yet
+            match = re.match(r'bytes=\d+-(\d+)', response.get('range', ''))
+            return int(match.group(1)) + 1 if match else 0, None
+        raise apiclient.errors.HttpError(response, content, uri = sessionURI)
         
+    @traced('insertPermission', lambda self, fileIDs, *args: {'files': len(fileIDs)})
     def insertPermission(self, fileIDs, permission):
-        makeRequest = lambda i: self.service.permissions().insert(fileId = fileIDs[i], body = permission)
-        return GoogleDriveManager.executeMultipleRequests(fileIDs, makeRequest)
+        makeRequest = lambda fileID: self.service.permissions().insert(fileId = fileID, body = permission)
+        return self.executeMultipleRequests(fileIDs, makeRequest)
         
+    @traced('getFileInfo', lambda self, fileIDs: {'files': len(fileIDs)})
     def getFileInfo(self, fileIDs):
-        makeRequest = lambda i: self.service.files().get(fileId = fileIDs[i])
-        return GoogleDriveManager.executeMultipleRequests(fileIDs, makeRequest)
+        makeRequest = lambda fileID: self.service.files().get(fileId = fileID)
+        return self.executeMultipleRequests(fileIDs, makeRequest)
         
-    @staticmethod
-    def executeMultipleRequests(responseOrder, makeRequest):
-        responses = [None for i in xrange(len(responseOrder))]
-        def batchCallback(request_id, response, exception):
+    def executeMultipleRequests(self, requestIDs, makeRequest):
+        # responses keep the order of requestIDs; a request ID that appears more than once is sent once
+        responses = {}
+        pendingIDs = list(collections.OrderedDict.fromkeys(requestIDs))
+        attempt = 0
+        while pendingIDs:
+            errors = {}
+            batches = [pendingIDs[i:i + GoogleDriveManager.batchSizeLimit] for i in xrange(0, len(pendingIDs), GoogleDriveManager.batchSizeLimit)]
+            runInParallel(lambda batchIDs: self.executeBatch(batchIDs, makeRequest, responses, errors), batches, self.batchWorkers, stopOnFailure = False)
+            pendingIDs = [requestID for requestID in pendingIDs if requestID not in responses]
+            if not pendingIDs:
+                break
+            # only the failed calls are sent again, and only if waiting may help
+            attempt += 1
+            fatalIDs = [requestID for requestID in pendingIDs if not GoogleDriveManager.isRetryableError(errors.get(requestID))]
+            if fatalIDs or attempt > self.retries:
+                failedIDs = fatalIDs or pendingIDs
+                for requestID in failedIDs:
+                    print 'request for %s failed: %s' % (requestID, errors.get(requestID))
+                if errors.get(failedIDs[0]):
+                    raise errors[failedIDs[0]]
+                raise RuntimeError('request for %s got no response' % failedIDs[0])
+            delay = min(2 ** (attempt - 1), GoogleDriveManager.maximumRetryDelay)
+            print '%d of %d requests to Google Drive failed. Retry in %ds' % (len(pendingIDs), len(responses) + len(pendingIDs), delay)
+            time.sleep(delay)
+        return [responses[requestID] for requestID in requestIDs]
+        
+    def executeBatch(self, requestIDs, makeRequest, responses, errors):
+        def batchCallback(requestID, response, exception):
             if exception:
-                return
-            responses[responseOrder.index(request_id)] = response
-
-        batch = BatchHttpRequest()
-        for i in xrange(len(responseOrder)):
-            batch.add(makeRequest(i), request_id = responseOrder[i], callback = batchCallback)
-        batch.execute()
-        return responses
-    
-def uploadToGoogleDrive(filePaths, transferInfo):
-    if not filePaths:
-        return []
+                errors[requestID] = exception
+            else:
+                responses[requestID] = response
+                
+        # the service knows the batch endpoint of the API it was built from
+        batch = self.service.new_batch_http_request(callback = batchCallback)
+        for requestID in requestIDs:
+            batch.add(makeRequest(requestID), request_id = requestID)
+        with tracer.span('batch', requests = len(requestIDs)):
+            try:
+                batch.execute(http = self.batchConnection())
+            except (apiclient.errors.HttpError,) + GoogleDriveManager.transientErrors as error:
+                for requestID in requestIDs:
+                    errors.setdefault(requestID, error)
+        return True
+        
+    def batchConnection(self):
+        # batches sent at the same time need their own connections, which httplib2 cannot share between threads
+        if self.batchWorkers <= 1:
+            return self.http
+        http = getattr(self.batchConnections, 'http', None)
+        if not http:
+            http = self.batchConnections.http = self.credentials.authorize(httplib2.Http())
+        return http
         
-    credentialsStorage = Storage(CREDENTIALS_FILE)
+    @staticmethod
+    def isRetryableError(error):
+        if isinstance(error, apiclient.errors.HttpError):
+            if error.resp.status == 403:
+                try:
+                    reasons = [detail.get('reason') for detail in json.loads(error.content)['error']['errors']]
+                except (ValueError, KeyError, TypeError):
+                    return False
+                return any(reason in GoogleDriveManager.rateLimitReasons for reason in reasons)
+            return error.resp.status in GoogleDriveManager.transientStatuses
+        return isinstance(error, GoogleDriveManager.transientErrors)
+    
+def loadDriveDiscoveryDocument(discoveryServiceUrl, cachePath, timeToLive):
+    # the document describes the API and rarely changes, so it is fetched at most once per timeToLive
+    discoveryUrl = (discoveryServiceUrl or apiclient.discovery.DISCOVERY_URI).replace('{api}', 'drive').replace('{apiVersion}', 'v2')
+    cachedDocument = loadJSONFile(cachePath, {})
+    if cachedDocument.get('url') != discoveryUrl:
+        cachedDocument = {}
+    if cachedDocument and time.time() - cachedDocument['fetchTime'] < timeToLive:
+        return cachedDocument['document']
+    try:
+        response, content = httplib2.Http(timeout = 60).request(discoveryUrl)
+        if response.status != 200:
+            raise apiclient.errors.HttpError(response, content, uri = discoveryUrl)
+        document = json.loads(content)
+    except (apiclient.errors.HttpError, ValueError, httplib2.HttpLib2Error) + GoogleDriveManager.transientErrors as error:
+        if not cachedDocument:
+            raise
+        print 'could not fetch %s (%s). Use the cached one' % (discoveryUrl, str(error) or type(error).__name__)
+        return cachedDocument['document']
+    saveJSONFile(cachePath, {'url': discoveryUrl, 'fetchTime': time.time(), 'document': document})
+    return document
+    
+def loadGoogleCredentials(transferInfo, credentialsFile = CREDENTIALS_FILE):
+    import webbrowser
+    credentialsStorage = oauth2client.file.Storage(credentialsFile)
     credentials = credentialsStorage.get()
     if not credentials or not credentials.refresh_token:
-        flow = OAuth2WebServerFlow(transferInfo['CLIENT_ID'], transferInfo['CLIENT_SECRET'], OAUTH_SCOPE, REDIRECT_URI)
+        flow = oauth2client.client.OAuth2WebServerFlow(transferInfo['CLIENT_ID'], transferInfo['CLIENT_SECRET'], OAUTH_SCOPE, REDIRECT_URI)
         authorize_url = flow.step1_get_authorize_url()
         webbrowser.open_new(authorize_url)
         print 'Could not find valid credentials. Re-request access rights.'
         code = raw_input('Enter verification code: ').strip()
         credentials = flow.step2_exchange(code)
         credentialsStorage.put(credentials)
+    elif not credentials.access_token or credentials.access_token_expired:
+        # refresh once here rather than in every worker; the storage keeps the token for the next run
+        credentials.refresh(httplib2.Http())
+    return credentials
     
-    driveManager = GoogleDriveManager()
-    driveManager.authorize(credentials)
-
-    fileIDs = []
-    targetFolderID = driveManager.makeDirectory(transferInfo['GOOGLE_DRIVE_PATH'])
-    for filePath in filePaths:
-        print 'uploading %s......' % filePath,
-        uploadedFileID = driveManager.insertFile(filePath, targetFolderID, lambda progress: printProgress(progress * 100, True))
-        printProgress(100, False)
-        fileIDs.append(uploadedFileID)
-        
-    new_permission = {
-        'type': 'anyone',
-        'role': 'reader',
-        'withLink': True
-    }
-    driveManager.insertPermission(fileIDs, new_permission)
-
-    # get the link
-    uploadedFileInfo = driveManager.getFileInfo(fileIDs)
-    return map(lambda fileInfo: fileInfo['webContentLink'], uploadedFileInfo)
-    
-class FTPUploadProgressHandler(object):
-    def __init__(self, expectedSize):
+class UploadProgressHandler(object):
+    def __init__(self, expectedSize, showsProgress = True):
         self.__totalUploadedSize = 0
         self.expectedSize = expectedSize
+        self.showsProgress = showsProgress
+        # what this run has actually sent, not counting what an earlier attempt left on the server
+        self.bytesWritten = 0
+        
+    def resume(self, offset):
+        self.__totalUploadedSize = offset
         
     def update(self, uploadedSize):
         self.__totalUploadedSize += uploadedSize
-        printProgress(int(self.__totalUploadedSize / float(self.expectedSize) * 100), self.__totalUploadedSize < self.expectedSize)
+        self.bytesWritten += uploadedSize
+        if self.showsProgress:
+            printProgress(int(self.__totalUploadedSize / float(max(self.expectedSize, 1)) * 100), self.__totalUploadedSize < self.expectedSize)
+            
+    def moveTo(self, uploadedSize):
+        # for the destinations that only tell how far the upload has got
+        self.update(max(uploadedSize - self.__totalUploadedSize, 0))
+        
+class BaseUploader(object):
+    # a destination of the ipas. A subclass stores a file from the stream given by openStream(), finds out whether
+    # an identical file is there already and turns what it has stored into links. Skipping the identical files,
+    # retrying and reporting the progress are done here, and the workers are those of TransferStage
+    defaultName = None
+    # the errors after which the connection is abandoned and the upload is tried again
+    transientErrors = (EOFError, socket.error)
+    maximumRetryDelay = 30
+    # whether the uploader keeps credentials or caches in dataFolder, so that it cannot be shared by other projects
+    usesDataFolder = False
+    
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        self.transferInfo = transferInfo
+        self.showsProgress = showsProgress
+        self.skipsIdenticalFiles = skipsIdenticalFiles
+        self.dataFolder = dataFolder
+        self.name = name or self.defaultName
+        self.retries = transferInfo.get('UPLOAD_RETRIES', 5)
+        
+    def clone(self):
+        # clones hold connections of their own; subclasses hand them what can be shared
+        return type(self)(self.transferInfo, self.showsProgress, self.skipsIdenticalFiles, self.dataFolder, self.name)
+        
+    def openStream(self, filePath):
+        # the limits on the rate of this destination and of every upload apply to whatever is read from it
+        return artifactReaders.open(filePath, functools.partial(resourceScheduler.throttleUpload, self.name))
+        
+    def upload(self, filePath):
+        fileName = os.path.split(filePath)[1]
+        if isinstance(fileName, unicode):
+            fileName = fileName.encode('utf-8')
+        if self.skipsIdenticalFiles:
+            try:
+                self.open()
+                uploadResult = self.findIdenticalFile(filePath, fileName)
+            except self.transientErrors:
+                # let the upload deal with the connection
+                self.abandon()
+                uploadResult = None
+            if uploadResult is not None:
+                print '%s is already on %s' % (filePath, self.name)
+                return uploadResult
+        if self.showsProgress:
+            print 'uploading %s......' % filePath,
+        progressHandler = UploadProgressHandler(os.path.getsize(filePath), self.showsProgress)
+        startTime = time.time()
+        attempt = 0
+        while True:
+            try:
+                self.open()
+                uploadResult = self.put(filePath, fileName, progressHandler, attempt)
+                break
+            except self.transientErrors as error:
+                attempt += 1
+                self.abandon()
+                if attempt > self.retries:
+                    raise
+                delay = min(2 ** (attempt - 1), BaseUploader.maximumRetryDelay)
+                print 'uploading %s to %s was interrupted (%s). Retry in %ds' % (filePath, self.name, str(error) or type(error).__name__, delay)
+                time.sleep(delay)
+                
+        elapsedTime = max(time.time() - startTime, 0.001)
+        if not self.showsProgress:
+            print 'uploaded %s to %s (%.1f MB in %.1fs, %.2f MB/s)' % (filePath, self.name, progressHandler.bytesWritten / 1048576.0, elapsedTime, progressHandler.bytesWritten / 1048576.0 / elapsedTime)
+        return uploadResult
+        
+    def open(self):
+        pass
+        
+    def findIdenticalFile(self, filePath, fileName):
+        # returns what upload() would have returned for the file, or None if it has to be uploaded
+        return None
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        # a retry may continue where the interrupted attempt stopped
+        pass
+        
+    def finish(self, uploadResults):
+        # the links to the files, in the order of uploadResults, once every file is uploaded
+        return uploadResults
+        
+    def describe(self):
+        return self.name
+        
+    def ping(self):
+        pass
+        
+    def close(self):
+        pass
+        
+    def abandon(self):
+        self.close()
+        
+class GoogleDriveUploader(BaseUploader):
+    defaultName = 'Google Drive'
+    # GoogleDriveManager retries every chunk and every batch by itself
+    transientErrors = ()
+    usesDataFolder = True
+    
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        super(GoogleDriveUploader, self).__init__(transferInfo, showsProgress, skipsIdenticalFiles, dataFolder, name)
+        importGoogleAPIClient()
+        # the credentials and the caches are kept in dataFolder, or in the working directory if it is not given
+        dataPath = lambda fileName: os.path.abspath(os.path.join(dataFolder or '', fileName))
+        self.credentialsFile = dataPath(CREDENTIALS_FILE)
+        self.discoveryCachePath = dataPath(DRIVE_DISCOVERY_CACHE_FILE)
+        self.discoveryDocument = None
+        self.folderCache = DriveFolderCache(dataPath(DRIVE_FOLDER_CACHE_FILE))
+        self.uploadJournal = DriveUploadJournal(dataPath(DRIVE_UPLOAD_JOURNAL_FILE))
+        self.credentials = None
+        self.driveManager = None
+        self.targetFolderID = None
+        
+    def clone(self):
+        # clones share the credentials and the target folder but talk to Drive over their own connection
+        uploader = super(GoogleDriveUploader, self).clone()
+        uploader.credentials = self.credentials
+        uploader.discoveryDocument = self.discoveryDocument
+        uploader.folderCache = self.folderCache
+        uploader.uploadJournal = self.uploadJournal
+        uploader.targetFolderID = self.targetFolderID
+        return uploader
+        
+    def open(self):
+        if self.driveManager:
+            return
+        if not self.credentials:
+            self.credentials = loadGoogleCredentials(self.transferInfo, self.credentialsFile)
+        if not self.discoveryDocument:
+            self.discoveryDocument = loadDriveDiscoveryDocument(self.transferInfo.get('DISCOVERY_SERVICE_URL'), self.discoveryCachePath,
+                                                                self.transferInfo.get('DISCOVERY_CACHE_TTL', 86400))
+        driveManager = GoogleDriveManager(self.transferInfo.get('DISCOVERY_SERVICE_URL'), self.folderCache, self.uploadJournal,
+                                          self.transferInfo.get('UPLOAD_CHUNK_SIZE', 1 << 20), self.transferInfo.get('UPLOAD_RETRIES', 5),
+                                          self.transferInfo.get('BATCH_WORKERS', 1))
+        driveManager.destinationName = self.name
+        driveManager.authorize(self.credentials, self.discoveryDocument)
+        if not self.targetFolderID:
+            self.targetFolderID = driveManager.makeDirectory(self.transferInfo['GOOGLE_DRIVE_PATH'])
+        self.driveManager = driveManager
+        
+    def findIdenticalFile(self, filePath, fileName):
+        return self.driveManager.findIdenticalFile(filePath, self.targetFolderID)
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        # the upload session continues where the last one stopped, even that of an earlier run
+        return self.driveManager.insertFile(filePath, self.targetFolderID, lambda progress: progressHandler.moveTo(int(progress * progressHandler.expectedSize)))
+        
+    def finish(self, fileIDs):
+        if not fileIDs:
+            return []
+        self.open()
+        new_permission = {
+            'type': 'anyone',
+            'role': 'reader',
+            'withLink': True
+        }
+        self.driveManager.insertPermission(fileIDs, new_permission)
+
+        # get the link
+        uploadedFileInfo = self.driveManager.getFileInfo(fileIDs)
+        return map(lambda fileInfo: fileInfo['webContentLink'], uploadedFileInfo)
+        
+    def describe(self):
+        return '%s of %s' % (self.transferInfo['GOOGLE_DRIVE_PATH'], self.name)
+        
+    def ping(self):
+        # every request opens a connection of its own if the kept one has been dropped
+        pass
+        
+    def close(self):
+        self.driveManager = None
     
 def FTPMakeWholeDirectory(FTPClient, directory):
     components = splitPathIntoComponents(directory)
@@ -442,84 +2471,1012 @@ def FTPMakeWholeDirectory(FTPClient, directory):
         except ftplib.error_perm:
             FTPClient.mkd(component)
             FTPClient.cwd(component)
+            
+class FTPUploader(BaseUploader):
+    defaultName = 'FTP server'
     
-def uploadToFTPServer(filePaths, transferInfo):
-    if not filePaths:
-        return []
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        super(FTPUploader, self).__init__(transferInfo, showsProgress, skipsIdenticalFiles, dataFolder, name)
+        importFTPLib()
+        self.transientErrors = (ftplib.error_temp, ftplib.error_reply, EOFError, socket.error)
+        self.loginInfo = urlparse.urlparse(transferInfo['FTP_SERVER_URL'])
+        self.blockSize = transferInfo.get('FTP_BLOCK_SIZE', 1 << 20)
+        self.retries = transferInfo.get('FTP_RETRIES', 5)
+        self.timeout = transferInfo.get('FTP_TIMEOUT', 120)
+        # a file of the same size only counts as identical without a digest if asked for
+        self.skipsSameSize = transferInfo.get('FTP_SKIPS_SAME_SIZE', False)
+        self.FTPClient = None
+        self.buildDir = None
+        # HASH, XMD5 or '' once the features of the server are known
+        self.digestCommand = None
         
-    loginInfo = urlparse.urlparse(transferInfo['FTP_SERVER_URL'])
-    FTPClient = None
-    fileHandles = []
-    filesUploaded = []
-    try:
-        FTPClient = ftplib.FTP(loginInfo.hostname, loginInfo.username, loginInfo.password)
-        buildDir = transferInfo['FTP_SERVER_BUILD_DIRECTORY']
-        # create directory if it does not exist
+    def clone(self):
+        # every clone holds its own connection to the server
+        uploader = super(FTPUploader, self).clone()
+        uploader.buildDir = self.buildDir
+        uploader.digestCommand = self.digestCommand
+        return uploader
+        
+    def open(self):
+        if self.FTPClient:
+            return
+        FTPClient = ftplib.FTP()
         try:
-            FTPClient.cwd(buildDir)
+            FTPClient.connect(self.loginInfo.hostname, self.loginInfo.port or ftplib.FTP_PORT, self.timeout)
+            FTPClient.login(self.loginInfo.username, self.loginInfo.password)
+            if self.buildDir:
+                FTPClient.cwd(self.buildDir)
+            else:
+                buildDir = self.transferInfo['FTP_SERVER_BUILD_DIRECTORY']
+                # create directory if it does not exist
+                try:
+                    FTPClient.cwd(buildDir)
+                except ftplib.error_perm:
+                    print '%s may not exist. Create one' % buildDir
+                    FTPMakeWholeDirectory(FTPClient, buildDir)
+                self.buildDir = FTPClient.pwd()
+        except:
+            FTPClient.close()
+            raise
+        self.FTPClient = FTPClient
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        # a retry continues where the dropped transfer stopped; the first attempt always
+        # overwrites since a file of the same name may be left over from another build
+        offset = self.remoteSize(fileName) if attempt else 0
+        self.storeFile(filePath, fileName, offset, progressHandler)
+        return self.remoteLink(fileName)
+        
+    def remoteLink(self, fileName):
+        return '%s://%s%s' % (self.loginInfo.scheme, self.loginInfo.hostname, os.path.join(self.buildDir, fileName))
+        
+    def findIdenticalFile(self, filePath, fileName):
+        if self.remoteSize(fileName) != os.path.getsize(filePath):
+            return None
+        remoteDigest = self.remoteDigest(fileName)
+        if remoteDigest is None:
+            # a server without HASH or XMD5 can only compare sizes
+            if not self.skipsSameSize:
+                return None
+            print '%s on %s is taken as identical on size only, since the server cannot compare digests' % (fileName, self.name)
+            return self.remoteLink(fileName)
+        return self.remoteLink(fileName) if remoteDigest == artifactReaders.getDigests(filePath)['md5'] else None
+            
+    def remoteDigest(self, fileName):
+        if self.digestCommand is None:
+            self.digestCommand = self.findDigestCommand()
+        try:
+            if self.digestCommand == 'HASH':
+                # the algorithm is chosen per connection
+                self.FTPClient.sendcmd('OPTS HASH MD5')
+                response = self.FTPClient.sendcmd('HASH %s' % fileName)
+            elif self.digestCommand == 'XMD5':
+                response = self.FTPClient.sendcmd('XMD5 %s' % fileName)
+            else:
+                return None
         except ftplib.error_perm:
-            print '%s may not exist. Create one' % buildDir
-            FTPMakeWholeDirectory(FTPClient, buildDir)
-        buildDir = FTPClient.pwd()
-        for filePath in filePaths:
-            print 'uploading %s......' % filePath,
-            fileHandles.append(open(filePath, 'rb'))
-            fileName = os.path.split(filePath)[1]
-            FTPCommand = 'STOR %s' % (fileName.encode('utf-8') if isinstance(fileName, unicode) else fileName,)
-            blockSize = 8192
-            progressHandler = FTPUploadProgressHandler(os.path.getsize(filePath))
-            FTPClient.storbinary(FTPCommand, fileHandles[-1], blockSize, lambda block: progressHandler.update(blockSize))
-            FTPLink = '%s://%s%s' % (loginInfo.scheme, loginInfo.hostname, os.path.join(buildDir, os.path.split(filePath)[1]))
-            filesUploaded.append(FTPLink)
-    except:
-        excInfo = sys.exc_info()
-        traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
-    # cleanup
-    if fileHandles:
-        for fileHandle in fileHandles:
-            fileHandle.close()
-    try:
-        if FTPClient:
-            FTPClient.quit()
-    except:
-        pass
+            return None
+        match = re.search(r'\b([0-9a-fA-F]{32})\b', response[4:])
+        return match.group(1).lower() if match else None
+        
+    def findDigestCommand(self):
+        try:
+            features = [line.strip().upper() for line in self.FTPClient.sendcmd('FEAT').splitlines()[1:-1]]
+        except ftplib.error_perm:
+            return ''
+        for feature in features:
+            # e.g. HASH SHA-1;SHA-256;MD5*, where * marks the current algorithm
+            if feature.startswith('HASH ') and 'MD5' in feature[5:].replace('*', '').split(';'):
+                return 'HASH'
+        return 'XMD5' if 'XMD5' in features else ''
+        
+    def remoteSize(self, fileName):
+        # SIZE is only meaningful in binary mode
+        self.FTPClient.voidcmd('TYPE I')
+        try:
+            return self.FTPClient.size(fileName) or 0
+        except ftplib.error_perm:
+            return 0
+            
+    def storeFile(self, filePath, fileName, offset, progressHandler):
+        if offset == progressHandler.expectedSize:
+            # only the reply of the last attempt was lost
+            progressHandler.resume(offset)
+            return
+        if offset > progressHandler.expectedSize:
+            offset = 0
+        progressHandler.resume(offset)
+        with self.openStream(filePath) as fileHandle, tracer.span('storbinary', file = fileName, offset = offset) as span:
+            fileHandle.seek(offset)
+            def blockSent(block):
+                progressHandler.update(len(block))
+                span.addBytes(len(block))
+            self.FTPClient.storbinary('STOR %s' % fileName, fileHandle, self.blockSize, blockSent, offset or None)
+            
+    def describe(self):
+        return '%s of %s' % (self.transferInfo['FTP_SERVER_BUILD_DIRECTORY'], self.transferInfo['FTP_SERVER_URL'])
+        
+    def ping(self):
+        # the server may have dropped a connection that was kept open, in which case the next open() reconnects
+        try:
+            if self.FTPClient:
+                self.FTPClient.voidcmd('NOOP')
+        except self.transientErrors + (ftplib.error_perm,):
+            self.abandon()
+        
+    def close(self):
+        try:
+            if self.FTPClient:
+                self.FTPClient.quit()
+        except:
+            pass
+        self.FTPClient = None
+        
+    def abandon(self):
+        # a broken control connection cannot be quit politely
+        try:
+            if self.FTPClient:
+                self.FTPClient.close()
+        except:
+            pass
+        self.FTPClient = None
+    
+class SFTPUploader(BaseUploader):
+    defaultName = 'SFTP server'
+    
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        super(SFTPUploader, self).__init__(transferInfo, showsProgress, skipsIdenticalFiles, dataFolder, name)
+        importParamiko()
+        self.transientErrors = BaseUploader.transientErrors + (paramiko.SSHException,)
+        self.loginInfo = urlparse.urlparse(transferInfo['SFTP_SERVER_URL'])
+        self.blockSize = transferInfo.get('SFTP_BLOCK_SIZE', 1 << 20)
+        self.timeout = transferInfo.get('SFTP_TIMEOUT', 120)
+        # a file of the same size only counts as identical without a digest if asked for
+        self.skipsSameSize = transferInfo.get('SFTP_SKIPS_SAME_SIZE', False)
+        self.SSHClient = None
+        self.SFTPClient = None
+        self.buildDir = None
         
-    return filesUploaded
+    def clone(self):
+        uploader = super(SFTPUploader, self).clone()
+        uploader.buildDir = self.buildDir
+        return uploader
+        
+    def open(self):
+        if self.SFTPClient:
+            return
+        SSHClient = paramiko.SSHClient()
+        try:
+            SSHClient.load_system_host_keys()
+            # a server missing from known_hosts is refused unless the config says otherwise
+            if self.transferInfo.get('SFTP_ACCEPTS_UNKNOWN_HOSTS', False):
+                SSHClient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            SSHClient.connect(self.loginInfo.hostname, self.loginInfo.port or 22, self.loginInfo.username, self.loginInfo.password,
+                              key_filename = self.transferInfo.get('SFTP_KEY_FILE') or None, timeout = self.timeout,
+                              banner_timeout = self.timeout, look_for_keys = not self.loginInfo.password)
+            SFTPClient = SSHClient.open_sftp()
+            SFTPClient.get_channel().settimeout(self.timeout)
+            if self.buildDir:
+                SFTPClient.chdir(self.buildDir)
+            else:
+                buildDir = self.transferInfo['SFTP_SERVER_BUILD_DIRECTORY']
+                if buildDir.startswith('/'):
+                    SFTPClient.chdir('/')
+                # create directory if it does not exist
+                for component in splitPathIntoComponents(buildDir.strip('/')):
+                    try:
+                        SFTPClient.chdir(component)
+                    except IOError:
+                        SFTPClient.mkdir(component)
+                        SFTPClient.chdir(component)
+                self.buildDir = SFTPClient.getcwd()
+        except:
+            SSHClient.close()
+            raise
+        self.SSHClient = SSHClient
+        self.SFTPClient = SFTPClient
+        
+    def findIdenticalFile(self, filePath, fileName):
+        if self.remoteSize(fileName) != os.path.getsize(filePath):
+            return None
+        try:
+            with self.SFTPClient.open(fileName, 'rb') as remoteFile:
+                remoteDigest = binascii.hexlify(remoteFile.check('md5'))
+        except IOError:
+            # a server without the check-file extension can only compare sizes
+            if not self.skipsSameSize:
+                return None
+            print '%s on %s is taken as identical on size only, since the server cannot compare digests' % (fileName, self.name)
+            return self.remoteLink(fileName)
+        return self.remoteLink(fileName) if remoteDigest == artifactReaders.getDigests(filePath)['md5'] else None
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        # like FTP, a retry continues where the dropped transfer stopped
+        offset = self.remoteSize(fileName) if attempt else 0
+        if offset > progressHandler.expectedSize:
+            offset = 0
+        progressHandler.resume(offset)
+        if offset < progressHandler.expectedSize or not attempt:
+            with self.openStream(filePath) as fileHandle, self.SFTPClient.open(fileName, 'r+b' if offset else 'wb') as remoteFile,\
+                 tracer.span('sftpPut', file = fileName, offset = offset) as span:
+                # the writes are acknowledged in the background instead of one at a time
+                remoteFile.set_pipelined(True)
+                fileHandle.seek(offset)
+                remoteFile.seek(offset)
+                while True:
+                    block = fileHandle.read(self.blockSize)
+                    if not block:
+                        break
+                    remoteFile.write(block)
+                    progressHandler.update(len(block))
+                    span.addBytes(len(block))
+        return self.remoteLink(fileName)
+        
+    def remoteSize(self, fileName):
+        try:
+            return self.SFTPClient.stat(fileName).st_size
+        except IOError as error:
+            if isinstance(error, socket.error):
+                raise
+            return 0
+            
+    def remoteLink(self, fileName):
+        linkPrefix = self.transferInfo.get('LINK_PREFIX')
+        if linkPrefix:
+            return linkPrefix.rstrip('/') + '/' + urllib.quote(fileName)
+        return 'sftp://%s%s' % (self.loginInfo.hostname, posixpath.join(self.buildDir, fileName))
+        
+    def describe(self):
+        return '%s of sftp://%s' % (self.transferInfo['SFTP_SERVER_BUILD_DIRECTORY'], self.loginInfo.hostname)
+        
+    def ping(self):
+        try:
+            if self.SFTPClient:
+                self.SFTPClient.stat('.')
+        except self.transientErrors + (IOError,):
+            self.abandon()
+            
+    def close(self):
+        try:
+            if self.SSHClient:
+                self.SSHClient.close()
+        except:
+            pass
+        self.SSHClient = None
+        self.SFTPClient = None
+        
+class DirectoryUploader(BaseUploader):
+    # copies the ipas into a folder, which may be an NFS or SMB share mounted on this machine
+    defaultName = 'directory'
+    transientErrors = (IOError,)
+    # a relative DIRECTORY_PATH is relative to dataFolder
+    usesDataFolder = True
+    
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        super(DirectoryUploader, self).__init__(transferInfo, showsProgress, skipsIdenticalFiles, dataFolder, name)
+        self.folder = os.path.abspath(os.path.join(dataFolder or '', os.path.expanduser(transferInfo['DIRECTORY_PATH'])))
+        self.blockSize = transferInfo.get('DIRECTORY_BLOCK_SIZE', 1 << 20)
+        
+    def open(self):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+            
+    def findIdenticalFile(self, filePath, fileName):
+        targetPath = os.path.join(self.folder, fileName)
+        if not os.path.isfile(targetPath) or os.path.getsize(targetPath) != os.path.getsize(filePath):
+            return None
+        # reading the copy back costs less than writing it again, even over the network
+        if hashFile(targetPath, hashlib.md5) != artifactReaders.getDigests(filePath)['md5']:
+            return None
+        return self.remoteLink(fileName)
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        targetPath = os.path.join(self.folder, fileName)
+        # the copy gets its name only once it is complete, so that no one downloads half an ipa
+        temporaryPath = targetPath + '.part'
+        progressHandler.resume(0)
+        with self.openStream(filePath) as fileHandle, open(temporaryPath, 'wb') as targetFile, tracer.span('copyFile', file = fileName) as span:
+            while True:
+                block = fileHandle.read(self.blockSize)
+                if not block:
+                    break
+                targetFile.write(block)
+                progressHandler.update(len(block))
+                span.addBytes(len(block))
+            targetFile.flush()
+            os.fsync(targetFile.fileno())
+        os.rename(temporaryPath, targetPath)
+        return self.remoteLink(fileName)
+        
+    def remoteLink(self, fileName):
+        linkPrefix = self.transferInfo.get('LINK_PREFIX')
+        if linkPrefix:
+            return linkPrefix.rstrip('/') + '/' + urllib.quote(fileName)
+        return 'file://' + urllib.pathname2url(os.path.join(self.folder, fileName))
+        
+    def describe(self):
+        return self.folder
+        
+class S3Uploader(BaseUploader):
+    # Amazon S3 or any store with the same API, such as MinIO
+    defaultName = 'S3'
+    # botocore retries every request by itself
+    transientErrors = ()
+    
+    def __init__(self, transferInfo, showsProgress = True, skipsIdenticalFiles = True, dataFolder = None, name = None):
+        super(S3Uploader, self).__init__(transferInfo, showsProgress, skipsIdenticalFiles, dataFolder, name)
+        importBoto3()
+        self.bucket = transferInfo['S3_BUCKET']
+        self.keyPrefix = transferInfo.get('S3_KEY_PREFIX', '').strip('/')
+        self.client = None
+        
+    def open(self):
+        if self.client:
+            return
+        endpointURL = self.transferInfo.get('S3_ENDPOINT_URL') or None
+        # clients are thread safe but sessions are not, so every uploader makes its client from a session of its own
+        session = boto3.session.Session(aws_access_key_id = self.transferInfo.get('S3_ACCESS_KEY') or None,
+                                        aws_secret_access_key = self.transferInfo.get('S3_SECRET_KEY') or None,
+                                        region_name = self.transferInfo.get('S3_REGION') or None)
+        # the stores other than S3 seldom resolve buckets by host name
+        config = botocore.config.Config(retries = {'max_attempts': self.retries}, s3 = {'addressing_style': 'path'} if endpointURL else {})
+        client = session.client('s3', endpoint_url = endpointURL, config = config)
+        try:
+            client.head_bucket(Bucket = self.bucket)
+        except botocore.exceptions.ClientError as error:
+            if error.response.get('Error', {}).get('Code') not in ('404', 'NoSuchBucket'):
+                raise
+            print '%s may not exist. Create one' % self.bucket
+            client.create_bucket(Bucket = self.bucket)
+        self.client = client
+        
+    def objectKey(self, fileName):
+        return '/'.join([component for component in [self.keyPrefix, fileName] if component])
+        
+    def findIdenticalFile(self, filePath, fileName):
+        try:
+            objectInfo = self.client.head_object(Bucket = self.bucket, Key = self.objectKey(fileName))
+        except botocore.exceptions.ClientError as error:
+            if error.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                raise
+            return None
+        if objectInfo['ContentLength'] != os.path.getsize(filePath):
+            return None
+        # the ETag of an object uploaded in parts is not its MD5, which is why the MD5 is kept in the metadata as well
+        eTag = objectInfo.get('ETag', '').strip('"')
+        remoteDigest = objectInfo.get('Metadata', {}).get('md5') or (eTag if '-' not in eTag else None)
+        return self.objectKey(fileName) if remoteDigest == artifactReaders.getDigests(filePath)['md5'] else None
+        
+    def put(self, filePath, fileName, progressHandler, attempt):
+        # the checksum manifest of the mail needs the digests anyway
+        digest = artifactReaders.getDigests(filePath)['md5']
+        transferConfig = boto3.s3.transfer.TransferConfig(multipart_chunksize = self.transferInfo.get('S3_PART_SIZE', 8 << 20),
+                                                          max_concurrency = self.transferInfo.get('S3_PART_WORKERS', 4))
+        progressHandler.resume(0)
+        with self.openStream(filePath) as fileHandle, tracer.span('putObject', file = fileName) as span:
+            def partSent(byteCount):
+                progressHandler.update(byteCount)
+                span.addBytes(byteCount)
+            self.client.upload_fileobj(fileHandle, self.bucket, self.objectKey(fileName), Callback = partSent, Config = transferConfig,
+                                       ExtraArgs = {'ContentType': 'application/octet-stream', 'Metadata': {'md5': digest}})
+        return self.objectKey(fileName)
+        
+    def finish(self, objectKeys):
+        # the links are signed here rather than after every upload, so that they all expire together
+        linkPrefix = self.transferInfo.get('LINK_PREFIX')
+        if linkPrefix:
+            return [linkPrefix.rstrip('/') + '/' + urllib.quote(objectKey) for objectKey in objectKeys]
+        self.open()
+        return [self.client.generate_presigned_url('get_object', Params = {'Bucket': self.bucket, 'Key': objectKey},
+                                                   ExpiresIn = self.transferInfo.get('LINK_EXPIRATION', 7 * 86400)) for objectKey in objectKeys]
+        
+    def describe(self):
+        return '%s of bucket %s' % (self.keyPrefix or '/', self.bucket)
+        
+    def close(self):
+        self.client = None
+        
+class TransferStage(object):
+    priorityClasses = {'urgent': 0, 'normal': 1, 'bulk': 2}
+    
+    def __init__(self, name, uploader, condition, workers = 1, connectionCache = None, cacheKey = None):
+        self.name = name
+        self.uploader = uploader
+        self.condition = condition
+        self.workers = max(workers, 1)
+        # the uploaders are handed back to connectionCache under cacheKey instead of being closed
+        self.connectionCache = connectionCache
+        self.cacheKey = cacheKey
+        # the most urgent and then the smallest files go first
+        self.queue = Queue.PriorityQueue()
+        self.uploaders = []
+        self.threads = []
+        self.results = {}
+        self.failed = False
+        self.links = None
+        self.journal = None
+        
+    def open(self):
+        if self.connectionCache:
+            self.uploader = self.connectionCache.acquireUploader(self.cacheKey) or self.uploader
+        self.uploader.open()
+        
+    def start(self):
+        # the first worker uses the uploader opened by the caller, the others clone it
+        for index in xrange(self.workers):
+            uploader = None
+            if index and self.connectionCache:
+                uploader = self.connectionCache.acquireUploader(self.cacheKey)
+            uploader = uploader or (self.uploader if index == 0 else self.uploader.clone())
+            self.uploaders.append(uploader)
+            thread = threading.Thread(target = self.work, args = (uploader,), name = '%s #%d' % (self.name, index + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        
+    def submit(self, index, profile, filePath):
+        if not self.condition(profile):
+            return
+        uploadResult = self.journal.getUpload(self.name, filePath) if self.journal else None
+        if uploadResult:
+            print '%s has been uploaded to %s by the resumed release' % (filePath, self.name)
+            self.results[index] = uploadResult
+        else:
+            fileSize = os.path.getsize(filePath) if os.path.isfile(filePath) else 0
+            priority = (TransferStage.priorityClasses.get(profile.get('uploadPriority'), 1), fileSize)
+            self.queue.put((priority, index, filePath))
+            
+    def work(self, uploader):
+        while True:
+            priority, index, filePath = self.queue.get()
+            if filePath is None:
+                break
+            if self.failed:
+                # keep draining so that stop() does not block
+                continue
+            try:
+                # the priority also orders the uploads of every stage and every release waiting for a slot
+                with resourceScheduler.uploadSlots.slot(priority, file = os.path.basename(filePath)):
+                    self.results[index] = uploader.upload(filePath)
+                if self.journal:
+                    self.journal.recordUpload(self.name, filePath, self.results[index])
+            except:
+                self.failed = True
+                excInfo = sys.exc_info()
+                traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+                
+    def stop(self):
+        for thread in self.threads:
+            # after every file, whatever its priority
+            self.queue.put(((float('inf'),), None, None))
+            
+    def join(self):
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        try:
+            if not self.failed:
+                # links are listed in profile order no matter which upload finished first
+                self.links = self.uploader.finish([self.results[index] for index in sorted(self.results)])
+        except:
+            self.failed = True
+            excInfo = sys.exc_info()
+            traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+        for uploader in self.uploaders:
+            if self.connectionCache:
+                self.connectionCache.releaseUploader(self.cacheKey, uploader)
+            else:
+                uploader.close()
+        return self.links
+        
+class TransferEngine(object):
+    # destinations run side by side, each draining its own queue with its own pool of workers
+    def __init__(self, stages):
+        self.stages = stages
+        # keeps each file mapped until every destination is done with it
+        self.readers = []
+        
+    def setJournal(self, journal):
+        for stage in self.stages:
+            stage.journal = journal
+        
+    def start(self, items = ()):
+        # authorize up front so that prompts do not pop up in the middle of the transfers
+        for stage in self.stages:
+            stage.open()
+        # the files known at the start are all queued before any is taken, so that they go in order of priority
+        for index, profile, filePath in items:
+            self.submit(index, profile, filePath)
+        for stage in self.stages:
+            stage.start()
+            
+    def submit(self, index, profile, filePath):
+        if filePath and os.path.isfile(filePath):
+            self.readers.append(artifactReaders.acquire(filePath))
+        for stage in self.stages:
+            stage.submit(index, profile, os.path.abspath(filePath))
+            
+    def finish(self):
+        for stage in self.stages:
+            stage.stop()
+        results = dict([(stage.name, stage.join()) for stage in self.stages])
+        for reader in self.readers:
+            artifactReaders.release(reader)
+        self.readers = []
+        return results
+        
+uploaderClasses = {'googleDrive': GoogleDriveUploader, 'ftp': FTPUploader, 'sftp': SFTPUploader, 'directory': DirectoryUploader, 's3': S3Uploader}
 
-def sendNotificationMail(title, body, transferInfo):
-    container = MIMEMultipart()
-    container['Subject'] = title
-    container['From'] = transferInfo['SMTPUserAddress']
-    container['To'] = ','.join(transferInfo['toUsers'])
-    container.attach(MIMEText(body, 'html', 'utf-8'))
-    
-    SMTPClient = None
+def loadDestinations(buildConfig):
+    # the destinations that the profiles can name. Google Drive and the FTP server are configured where they always were
+    FTPInfo = dict([(key, buildConfig[key]) for key in ['FTP_SERVER_URL', 'FTP_SERVER_BUILD_DIRECTORY', 'FTP_BLOCK_SIZE', 'FTP_RETRIES', 'FTP_TIMEOUT',
+                                                         'FTP_SKIPS_SAME_SIZE']\
+                    if key in buildConfig])
+    FTPInfo.update(TYPE = 'ftp', UPLOAD_WORKERS = buildConfig.get('FTP_UPLOAD_WORKERS', 1), UPLOAD_RATE_LIMIT_MBPS = buildConfig.get('FTP_UPLOAD_RATE_LIMIT_MBPS', 0))
+    destinations = collections.OrderedDict([('Google Drive', dict(buildConfig.get('GOOGLE_API_CLIENT_INFO', {}), TYPE = 'googleDrive')),
+                                            ('FTP server', FTPInfo)])
+    destinations.update(sorted(buildConfig.get('DESTINATIONS', {}).items()))
+    return destinations
+    
+def listProfileDestinations(profile):
+    # the profiles of older config.json files choose the destinations with a flag for each
+    if 'destinations' in profile:
+        return profile['destinations']
+    return [name for name, key in [('Google Drive', 'uploadsToGoogleDrive'), ('FTP server', 'uploadsToFTPServer')] if profile.get(key)]
+    
+def createTransferEngine(buildConfig, dataFolder = None, connectionCache = None):
+    profiles = buildConfig['BUILD_PROFILES']
+    stages = []
+    skipsIdenticalFiles = buildConfig.get('SKIPS_IDENTICAL_UPLOADS', True)
+    # uploaders are only shared by releases that upload to the same place in the same way
+    generateCacheKey = lambda *components: json.dumps(components, sort_keys = True)
+    for name, destinationInfo in loadDestinations(buildConfig).items():
+        condition = lambda profile, name = name: name in listProfileDestinations(profile)
+        if not any(map(condition, profiles)):
+            continue
+        uploaderClass = uploaderClasses[destinationInfo['TYPE']]
+        uploader = uploaderClass(destinationInfo, False, skipsIdenticalFiles, dataFolder, name)
+        cacheKey = generateCacheKey(name, destinationInfo, skipsIdenticalFiles, os.path.abspath(dataFolder or '.') if uploaderClass.usesDataFolder else None)
+        stages.append(TransferStage(name, uploader, condition, destinationInfo.get('UPLOAD_WORKERS', 1), connectionCache, cacheKey))
+    return TransferEngine(stages)
+
+class MailOutbox(object):
+    # mails that still have recipients to reach, kept so that the next run can retry them
+    def __init__(self, outboxPath):
+        self.outboxPath = outboxPath
+        self.lock = threading.Lock()
+        self.messages = loadJSONFile(outboxPath, {})
+        
+    def post(self, title, body, sender, recipients):
+        messageID = hashlib.sha1(json.dumps([title, body, sender])).hexdigest()
+        with self.lock:
+            # a newer mail of the same release replaces the one still waiting
+            for otherID in [otherID for otherID, message in self.messages.items() if message['title'] == title and otherID != messageID]:
+                del self.messages[otherID]
+            message = self.messages.setdefault(messageID, {'title': title, 'body': body, 'sender': sender, 'recipients': {}})
+            for recipient in recipients:
+                # delivered and rejected recipients are final, only the deferred ones start over
+                if message['recipients'].get(recipient, {}).get('status', 'pending') == 'pending':
+                    message['recipients'][recipient] = {'status': 'pending', 'attempts': 0, 'reply': ''}
+            self.save()
+        return messageID
+        
+    def getMessage(self, messageID):
+        with self.lock:
+            return self.messages[messageID]
+            
+    def envelopes(self, envelopeSize):
+        envelopes = []
+        with self.lock:
+            for messageID, message in sorted(self.messages.items()):
+                recipients = sorted([recipient for recipient, status in message['recipients'].items() if status['status'] == 'pending'])
+                if not recipients:
+                    continue
+                size = envelopeSize or len(recipients)
+                envelopes.extend([(messageID, recipients[index:index + size]) for index in xrange(0, len(recipients), size)])
+        return envelopes
+        
+    def record(self, messageID, statuses):
+        with self.lock:
+            for recipient, (status, reply) in statuses.items():
+                entry = self.messages[messageID]['recipients'][recipient]
+                entry['status'] = status
+                entry['reply'] = reply
+                entry['attempts'] += 1
+            self.save()
+            
+    def report(self, messageID):
+        # prints how every recipient fared and drops the mail once nobody is left to retry
+        with self.lock:
+            recipients = self.messages[messageID]['recipients']
+            counts = collections.Counter([status['status'] for status in recipients.values()])
+            print 'mail %s: %d delivered, %d deferred, %d rejected' % (messageID[:8], counts['delivered'], counts['pending'], counts['rejected'])
+            for recipient, status in sorted(recipients.items()):
+                if status['status'] != 'delivered':
+                    print '    %s %s after %d attempts (%s)' % (recipient, 'deferred' if status['status'] == 'pending' else 'rejected', status['attempts'], status['reply'])
+            if not counts['pending']:
+                del self.messages[messageID]
+                self.save()
+            return not counts['pending'] and counts['delivered'] > 0
+            
+    def save(self):
+        saveJSONFile(self.outboxPath, self.messages)
+        
+class SMTPConnectionPool(object):
+    # authenticated connections are handed from one envelope to the next instead of logging in for each
+    idleProbeInterval = 10
+    
+    def __init__(self, transferInfo):
+        self.transferInfo = transferInfo
+        self.idleClients = Queue.Queue()
+        
+    def acquire(self):
+        import smtplib
+        while True:
+            try:
+                SMTPClient, idleSince = self.idleClients.get_nowait()
+            except Queue.Empty:
+                break
+            if time.time() - idleSince < SMTPConnectionPool.idleProbeInterval:
+                return SMTPClient
+            # servers drop connections that have been idle for a while
+            try:
+                if SMTPClient.noop()[0] == 250:
+                    return SMTPClient
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.discard(SMTPClient)
+        SMTPClient = smtplib.SMTP(self.transferInfo['SMTPServer'])
+        try:
+            SMTPClient.ehlo()
+            if SMTPClient.has_extn('STARTTLS'):
+                SMTPClient.starttls()
+            SMTPClient.login(self.transferInfo['SMTPUser'], self.transferInfo['SMTPPassword'])
+        except:
+            self.discard(SMTPClient)
+            raise
+        return SMTPClient
+        
+    def release(self, SMTPClient):
+        self.idleClients.put((SMTPClient, time.time()))
+        
+    def discard(self, SMTPClient):
+        try:
+            SMTPClient.close()
+        except:
+            pass
+            
+    def close(self):
+        while True:
+            try:
+                SMTPClient = self.idleClients.get_nowait()[0]
+            except Queue.Empty:
+                return
+            try:
+                SMTPClient.quit()
+            except:
+                self.discard(SMTPClient)
+                
+class MailDeliveryEngine(object):
+    # sends a mail in envelopes of a limited number of recipients over pooled connections,
+    # retrying the recipients that the server defers
+    maximumRetryDelay = 30
+    
+    def __init__(self, transferInfo, outbox, pool = None):
+        self.transferInfo = transferInfo
+        self.outbox = outbox
+        self.envelopeSize = transferInfo.get('recipientsPerMessage', 50)
+        self.workers = transferInfo.get('sendWorkers', 1)
+        self.retries = transferInfo.get('sendRetries', 3)
+        # a pool given by the caller outlives the delivery and stays open
+        self.pool = pool or SMTPConnectionPool(transferInfo)
+        self.closesPool = pool is None
+        
+    def deliver(self, title, body):
+        messageID = self.outbox.post(title, body, self.transferInfo['SMTPUserAddress'], self.transferInfo['toUsers'])
+        # mails left over from earlier runs go out with this one
+        envelopes = self.outbox.envelopes(self.envelopeSize)
+        try:
+            runInParallel(self.sendEnvelope, envelopes, self.workers, False)
+        finally:
+            if self.closesPool:
+                self.pool.close()
+        for otherID in sorted(set([envelope[0] for envelope in envelopes]) - set([messageID])):
+            self.outbox.report(otherID)
+        return self.outbox.report(messageID)
+        
+    def composeMessage(self, message, recipients):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        
+        container = MIMEMultipart()
+        container['Subject'] = message['title']
+        container['From'] = message['sender']
+        container['To'] = ','.join(recipients)
+        container.attach(MIMEText(message['body'], 'html', 'utf-8'))
+        return container.as_string()
+        
+    def sendEnvelope(self, envelope):
+        import smtplib
+        
+        messageID, recipients = envelope
+        message = self.outbox.getMessage(messageID)
+        attempt = 0
+        while True:
+            SMTPClient = None
+            try:
+                SMTPClient = self.pool.acquire()
+                refused = SMTPClient.sendmail(message['sender'], recipients, self.composeMessage(message, recipients))
+                self.pool.release(SMTPClient)
+                replies = dict([(recipient, refused.get(recipient, (250, 'OK'))) for recipient in recipients])
+                envelopeError = None
+            except smtplib.SMTPRecipientsRefused as error:
+                self.pool.release(SMTPClient)
+                replies = error.recipients
+                envelopeError = None
+            except (smtplib.SMTPException, socket.error) as error:
+                if SMTPClient:
+                    self.pool.discard(SMTPClient)
+                replies = None
+                envelopeError = str(error) or type(error).__name__
+                # a refused sender, message or login is as final for every recipient as a refused recipient is
+                errorCode = getattr(error, 'smtp_code', None)
+                envelopeStatus = 'rejected' if isinstance(errorCode, int) and MailDeliveryEngine.classifyReply(errorCode) == 'rejected' else 'pending'
+                
+            if replies is None:
+                # the whole envelope failed; only a permanent reply says anything final about its recipients
+                statuses = dict([(recipient, (envelopeStatus, envelopeError)) for recipient in recipients])
+            else:
+                statuses = dict([(recipient, (MailDeliveryEngine.classifyReply(code), '%d %s' % (code, reply))) for recipient, (code, reply) in replies.items()])
+            self.outbox.record(messageID, statuses)
+            recipients = [recipient for recipient, (status, reply) in statuses.items() if status == 'pending']
+            if not recipients:
+                return True
+            attempt += 1
+            if attempt > self.retries:
+                return False
+            delay = min(2 ** (attempt - 1), MailDeliveryEngine.maximumRetryDelay)
+            print 'sending mail to %d recipients was deferred (%s). Retry in %ds' % (len(recipients), envelopeError or statuses[recipients[0]][1], delay)
+            time.sleep(delay)
+            
+    @staticmethod
+    def classifyReply(code):
+        if 200 <= code < 300:
+            return 'delivered'
+        if 500 <= code < 600:
+            return 'rejected'
+        return 'pending'
+        
+@traced('sendNotificationMail')
+def sendNotificationMail(title, body, transferInfo, outboxPath, connectionPool = None):
     try:
-        SMTPClient = smtplib.SMTP(transferInfo['SMTPServer'])
-        if SMTPClient.has_extn('STARTTLS'):
-            SMTPClient.starttls()
-        SMTPClient.login(transferInfo['SMTPUser'], transferInfo['SMTPPassword'])
-        SMTPClient.sendmail(transferInfo['SMTPUserAddress'], transferInfo['toUsers'], container.as_string())
+        return MailDeliveryEngine(transferInfo, MailOutbox(outboxPath), connectionPool).deliver(title, body)
     except:
         excInfo = sys.exc_info()
         traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
-    try:
-        if SMTPClient:
-            SMTPClient.quit()
-    except:
-        pass
+        return False
 
 def filteredIpas(zippedIpas, condition):
     return [ipaTuple[0] for ipaTuple in zippedIpas if condition(ipaTuple) and bool(ipaTuple[0])]
 
 def generateHTMLHyperlinkListItems(linkList, linkDescriptions):
-    HTMLListItems = ''
+    HTMLListItems = []
     for link in linkList:
         if linkDescriptions.get(link, ''):
-            HTMLListItems = HTMLListItems + '<li><a href="%s">%s</a>(%s)</li>\n' % (link, link, linkDescriptions[link])
+            HTMLListItems.append('<li><a href="%s">%s</a>(%s)</li>\n' % (link, link, linkDescriptions[link]))
         else:
-            HTMLListItems = HTMLListItems + '<li><a href="%s">%s</a></li>\n' % (link, link)
-    return '<ul>%s</ul>' % HTMLListItems
+            HTMLListItems.append('<li><a href="%s">%s</a></li>\n' % (link, link))
+    return '<ul>%s</ul>' % ''.join(HTMLListItems)
+    
+def generateChecksumManifest(ipas, zippedLinks):
+    manifest = []
+    for ipa in ipas:
+        digests = artifactReaders.getDigests(ipa)
+        links = [link for ipaPath, link in zippedLinks if ipaPath == ipa]
+        manifest.append({'name': os.path.split(ipa)[1], 'size': os.path.getsize(ipa), 'sha256': digests['sha256'], 'md5': digests['md5'], 'links': links})
+    return manifest
+    
+def generateHTMLChecksumManifest(manifest):
+    HTMLTableRows = []
+    for entry in manifest:
+        links = '<br>'.join(['<a href="%s">%s</a>' % (link, link) for link in entry['links']])
+        HTMLTableRows.append('<tr><td>%s</td><td>%d</td><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (entry['name'], entry['size'], entry['sha256'], entry['md5'], links))
+    return '<table><tr><th>File</th><th>Size</th><th>SHA-256</th><th>MD5</th><th>Links</th></tr>\n%s</table>' % ''.join(HTMLTableRows)
+    
+class MailTemplate(object):
+    # splits a str.format template into literals and fields once so that rendering is a single join
+    formatter = string.Formatter()
+    
+    def __init__(self, text):
+        self.pieces = list(MailTemplate.formatter.parse(text))
+        self.fieldNames = set([fieldName for literal, fieldName, formatSpec, conversion in self.pieces if fieldName])
+        
+    def render(self, keywordDict):
+        formatter = MailTemplate.formatter
+        output = []
+        for literal, fieldName, formatSpec, conversion in self.pieces:
+            output.append(literal)
+            if fieldName is None:
+                continue
+            value = formatter.convert_field(formatter.get_field(fieldName, (), keywordDict)[0], conversion)
+            if formatSpec and '{' in formatSpec:
+                formatSpec = formatter.vformat(formatSpec, (), keywordDict)
+            output.append(formatter.format_field(value, formatSpec or ''))
+        return ''.join(output)
+        
+class BugCodeLinkifier(object):
+    # a '#' followed by a pattern represents an issue
+    def __init__(self, bugURLMap):
+        self.bugURLs = {}
+        alternatives = []
+        for index, (pattern, URL) in enumerate(bugURLMap.items()):
+            groupName = 'bug%d' % index
+            self.bugURLs[groupName] = URL
+            alternatives.append('#(?P<%s>%s)' % (groupName, pattern))
+        self.pattern = re.compile('|'.join(alternatives))
+        self.barePattern = re.compile('(?<![#\\w])(?:%s)' % '|'.join(['(?:%s)' % pattern for pattern in bugURLMap]))
+        
+    def linkify(self, text):
+        output = []
+        position = 0
+        for match in self.pattern.finditer(text):
+            # the group of the pattern closes after any group inside it, so it is the last group
+            bugCode = match.group(match.lastgroup)
+            URL = self.bugURLs[match.lastgroup].format(BUG_CODE = bugCode)
+            output.append(text[position:match.start()])
+            output.append('<a href="%s">%s</a>' % (URL, bugCode))
+            position = match.end()
+        output.append(text[position:])
+        return ''.join(output)
+        
+    def markBugCodes(self, text):
+        # prefixes the bug codes that are not marked yet with a '#'
+        return self.barePattern.sub(lambda match: '#' + match.group(0), text)
+        
+class SvnLogParser(object):
+    # an XMLParser target that collects the entries of svn log --xml as they are printed
+    def __init__(self):
+        self.entries = {}
+        self.entry = None
+        self.text = []
+        
+    def start(self, tag, attributes):
+        if tag == 'logentry':
+            self.entry = {'revision': int(attributes['revision'])}
+        self.text = []
+        
+    def data(self, data):
+        self.text.append(data)
+        
+    def end(self, tag):
+        if self.entry is None:
+            return
+        if tag == 'logentry':
+            self.entries[str(self.entry['revision'])] = self.entry
+            self.entry = None
+        elif tag in ('author', 'date', 'msg'):
+            self.entry['message' if tag == 'msg' else tag] = ''.join(self.text)
+            
+    def close(self):
+        return self.entries
+        
+class SvnLogCache(object):
+    # log entries by revision, so that every release only reads the revisions that are new to it
+    def __init__(self, cachePath, authOptions = '', commandRunner = commandRunner):
+        self.cachePath = cachePath
+        self.authOptions = authOptions
+        self.commandRunner = commandRunner
+        cache = loadJSONFile(cachePath, {})
+        self.entries = cache.get('entries', {})
+        # the revisions in [scannedFrom, scannedThrough] that are not in entries did not touch the working copy
+        self.scannedFrom = cache.get('scannedFrom')
+        self.scannedThrough = cache.get('scannedThrough')
+        self.lastReleasedRevision = cache.get('lastReleasedRevision')
+        
+    def update(self, firstRevision, lastRevision, limit):
+        if self.scannedFrom is None or firstRevision < self.scannedFrom or self.scannedThrough < firstRevision - 1:
+            entries = readSvnLog(firstRevision, lastRevision, limit, self.authOptions, self.commandRunner)
+            if entries is None:
+                return False
+            self.entries.update(entries)
+            reachedLimit = limit and len(entries) >= limit
+            self.scannedFrom = min([int(revision) for revision in entries]) if reachedLimit else firstRevision
+        elif lastRevision > self.scannedThrough:
+            entries = readSvnLog(self.scannedThrough + 1, lastRevision, None, self.authOptions, self.commandRunner)
+            if entries is None:
+                return False
+            self.entries.update(entries)
+        self.scannedThrough = max(lastRevision, self.scannedThrough)
+        self.save()
+        return True
+        
+    def getEntries(self, firstRevision, lastRevision):
+        entries = [entry for entry in self.entries.values() if firstRevision <= entry['revision'] <= lastRevision]
+        return sorted(entries, key = lambda entry: entry['revision'])
+        
+    def markReleased(self, revision):
+        self.lastReleasedRevision = revision
+        # the next release starts after this revision, so nothing before it is needed again
+        self.entries = dict([(key, entry) for key, entry in self.entries.items() if entry['revision'] > revision])
+        self.scannedFrom = max(self.scannedFrom, revision + 1)
+        self.save()
+        
+    def save(self):
+        saveJSONFile(self.cachePath, {'entries': self.entries, 'scannedFrom': self.scannedFrom, 'scannedThrough': self.scannedThrough,
+                                      'lastReleasedRevision': self.lastReleasedRevision})
+        
+def readWorkingCopyRevision(commandRunner = commandRunner):
+    from xml.etree import cElementTree
+    output = commandRunner.readOutput('svn info --xml')
+    if output is None:
+        return None
+    return int(cElementTree.fromstring(output).find('entry').get('revision'))
+    
+def readSvnLog(firstRevision, lastRevision, limit, authOptions, commandRunner = commandRunner):
+    # the log is parsed as svn prints it instead of after the whole history is in memory
+    from xml.etree import cElementTree
+    target = SvnLogParser()
+    parser = cElementTree.XMLParser(target = target)
+    parseErrors = []
+    def parseOutput(streamName, line):
+        if 'stdout' != streamName or parseErrors:
+            return
+        try:
+            parser.feed(line)
+        except SyntaxError as error:
+            # keep draining the output so that svn does not block on a full pipe
+            parseErrors.append(error)
+    # newest first, so that a limit keeps the latest revisions
+    command = 'svn log --xml %s -r %d:%d' % (authOptions, lastRevision, firstRevision)
+    if limit:
+        command += ' --limit %d' % limit
+    if not commandRunner.run(command, outputHandler = parseOutput).succeeded():
+        return None
+    if parseErrors:
+        print 'the output of svn log cannot be parsed: %s' % str(parseErrors[0])
+        return None
+    return parser.close()
+    
+def generateReleaseNotes(logCache, bugURLMap, limit):
+    # returns the notes of the revisions since the last release and the revision they go up to
+    revision = readWorkingCopyRevision(logCache.commandRunner)
+    if revision is None:
+        return None, None
+    firstRevision = (logCache.lastReleasedRevision or 0) + 1
+    if not logCache.update(firstRevision, revision, limit if not logCache.lastReleasedRevision else None):
+        return None, None
+    entries = logCache.getEntries(firstRevision, revision)
+    if limit:
+        entries = entries[-limit:]
+    linkifier = compileBugCodeLinkifier(bugURLMap) if bugURLMap else None
+    HTMLListItems = []
+    for entry in entries:
+        message = cgi.escape(entry.get('message', '').strip())
+        if linkifier:
+            # marked the way mailBody.html marks them, so that they are linked with the rest of the mail
+            message = linkifier.markBugCodes(message)
+        HTMLListItems.append('<li>%s (r%d, %s)</li>\n' % (message.replace('\n', '<br>\n'), entry['revision'], cgi.escape(entry.get('author', ''))))
+    return '<ol>\n%s</ol>' % ''.join(HTMLListItems), revision
+    
+# the daemon keeps the most recently used ones of every project it releases
+compiledCacheSize = 32
+compiledMailTemplates = collections.OrderedDict()
+compiledBugCodeLinkifiers = collections.OrderedDict()
+compiledLock = threading.Lock()
+
+def compileCached(cache, key, create):
+    with compiledLock:
+        compiled = cache.pop(key, None) or create()
+        cache[key] = compiled
+        while len(cache) > compiledCacheSize:
+            cache.popitem(last = False)
+        return compiled
+
+def compileMailTemplate(text):
+    return compileCached(compiledMailTemplates, text, lambda: MailTemplate(text))
+    
+def compileBugCodeLinkifier(bugURLMap):
+    return compileCached(compiledBugCodeLinkifiers, tuple(sorted(bugURLMap.items())), lambda: BugCodeLinkifier(bugURLMap))
     
 class MailBodyEditor(BaseEditor):
     def __init__(self, filePath):
@@ -528,34 +3485,31 @@ class MailBodyEditor(BaseEditor):
     def linkifyBugCodes(self, bugURLMap):
         if not bugURLMap:
             return
-            
-        bugURLs = bugURLMap.items()
-        groupPrefix = 'group'
-        # a '#' followed by a pattern represents an issue
-        bugURLPattern = '|'.join(['#(?P<%s>%s)' % (groupPrefix + str(index), bugURL[0]) for index, bugURL in enumerate(bugURLs)])
-        
-        def keyOfValidValue(dictionary):
-            for key in dictionary:
-                if dictionary[key]:
-                    return key
-            return None
-    
-        def getBugURL(match):
-            groupKey = keyOfValidValue(match.groupdict())
-            URL = bugURLs[int(groupKey[len(groupPrefix):])][1].format(**{'BUG_CODE': match.group(groupKey)})
-            return '<a href="%s">%s</a>' % (URL, match.group(groupKey))
-        self.fileData = re.sub(bugURLPattern, getBugURL, self.fileData)
+        self.fileData = compileBugCodeLinkifier(bugURLMap).linkify(self.fileData)
     
     def replaceKeywords(self, keywordDict):
-        self.fileData = self.fileData.format(**keywordDict)
+        self.fileData = compileMailTemplate(self.fileData).render(keywordDict)
         
-def loadConfig():
+loadedConfigs = {}
+loadedConfigsLock = threading.Lock()
+
+def loadConfig(scriptFolder = None):
     canContinue = True
     buildConfig = None
     configFile = None
     try:
-        configFile = open('config.json', 'r')
-        buildConfig = json.load(configFile)
+        configPath = os.path.abspath(os.path.join(scriptFolder or '', 'config.json'))
+        configStat = os.stat(configPath)
+        # a daemon parses the config of a project again only after it is edited
+        with loadedConfigsLock:
+            loadedConfig = loadedConfigs.get(configPath)
+        if loadedConfig and loadedConfig[0] == (configStat.st_size, configStat.st_mtime):
+            buildConfig = copy.deepcopy(loadedConfig[1])
+        else:
+            configFile = open(configPath, 'r')
+            buildConfig = json.load(configFile)
+            with loadedConfigsLock:
+                loadedConfigs[configPath] = ((configStat.st_size, configStat.st_mtime), copy.deepcopy(buildConfig))
         
         loadedKeysSet = set(buildConfig.keys())
         requiredKeysSet = set(['APP_VERSION', 'EXPORT_PATH_PREFIX', 'INFO_PLIST_PATH', 'FTP_SERVER_URL',\
@@ -565,6 +3519,16 @@ def loadConfig():
         if not loadedKeysSet.issuperset(requiredKeysSet):
             print 'some required keys are missing'
             canContinue = False
+        destinations = loadDestinations(buildConfig)
+        for name, destinationInfo in destinations.items():
+            if destinationInfo.get('TYPE') not in uploaderClasses:
+                print 'destination %s is of unknown type %s' % (name, destinationInfo.get('TYPE'))
+                canContinue = False
+        for profile in buildConfig.get('BUILD_PROFILES', []):
+            unknownDestinations = [name for name in listProfileDestinations(profile) if name not in destinations]
+            if unknownDestinations:
+                print 'profile %s uploads to %s, which are not in DESTINATIONS' % (profile.get('scheme'), ', '.join(unknownDestinations))
+                canContinue = False
     except:
         canContinue = False
         excInfo = sys.exc_info()
@@ -573,66 +3537,492 @@ def loadConfig():
         configFile.close()
     return canContinue, buildConfig
         
+def parseArguments(argv = None):
+    parser = argparse.ArgumentParser(description = 'Build the ipas described in config.json, upload them and send the notification mail.')
+    parser.add_argument('--force-rebuild', action = 'store_true', help = 'clean and archive every profile even if a matching archive is cached')
+    parser.add_argument('--trace', metavar = 'FILE', help = 'write the timing of every stage to FILE in Chrome trace format and print a summary')
+    parser.add_argument('--build-only', action = 'store_true', help = 'build the ipas without uploading them or sending the mail')
+    parser.add_argument('--resume', action = 'store_true', help = 'continue the last release from the stage where it failed')
+    parser.add_argument('--dry-run', action = 'store_true', help = 'print the ipas that would be built and where they would be uploaded, then quit')
+    parser.add_argument('--daemon', action = 'store_true', help = 'keep running and release the projects submitted to it, reusing the connections and caches of one release for the next')
+    parser.add_argument('--submit', action = 'store_true', help = 'queue the release of this folder, with the other options given, on the running daemon')
+    parser.add_argument('--jobs', action = 'store_true', help = 'list the releases queued on the running daemon')
+    parser.add_argument('--projects', nargs = '+', metavar = 'PATH', help = 'release every project given by its config.json, the folder of its config.json or its root at the same time and report on them together')
+    parser.add_argument('--report', metavar = 'FILE', help = 'with --projects, also write the report on every release to FILE as JSON')
+    return parser.parse_args(argv)
+    
 def main():
-    canContinue, buildConfig = loadConfig()
+    arguments = parseArguments()
+    # the limits on the builds and uploads of every release in the process come from the config.json here
+    localConfig = loadJSONFile('config.json', {})
+    resourceScheduler.configure(localConfig)
+    if arguments.daemon or arguments.submit or arguments.jobs:
+        daemonURL = 'http://127.0.0.1:%d' % localConfig.get('DAEMON_PORT', 8765)
+        if arguments.daemon:
+            ReleaseDaemon(localConfig.get('DAEMON_PORT', 8765), localConfig.get('DAEMON_WORKERS', 1)).serve()
+            return True
+        elif arguments.submit:
+            return submitRelease(daemonURL, os.getcwd(), [argument for argument in sys.argv[1:] if argument != '--submit'])
+        else:
+            return listReleaseJobs(daemonURL)
+    if arguments.trace:
+        arguments.trace = os.path.abspath(arguments.trace)
+        tracer.enable()
+    try:
+        if arguments.projects:
+            return releaseProjects(arguments, arguments.projects)
+        with tracer.span('release'):
+            return release(arguments)
+    finally:
+        if tracer.enabled:
+            tracer.writeChromeTrace(arguments.trace)
+            tracer.printSummary()
+            
+def printReleasePlan(builderModel):
+    # the build numbers are those a run would assign to the working copy as it is now
+    currentAppBuild = PlistDocument(builderModel.resolvePath(builderModel['INFO_PLIST_PATH'])).getValue('CFBundleVersion')
+    for profile in builderModel['BUILD_PROFILES']:
+        builderModel.nextBuildPathInfo(currentAppBuild, profile)
+        destinations = listProfileDestinations(profile)
+        print 'build %s from scheme %s and upload it to %s' % (builderModel.exportPath, profile['scheme'], ', '.join(destinations) or 'nowhere')
+        currentAppBuild = builderModel.buildNumber or currentAppBuild
+        
+class ReleaseReport(object):
+    # what a release has done, for a report that covers several releases
+    def __init__(self, scriptFolder):
+        self.scriptFolder = scriptFolder
+        self.appName = None
+        self.succeeded = None
+        self.startTime = time.time()
+        self.endTime = None
+        self.ipas = []
+        self.links = {}
+        self.commandStatistics = []
+        
+    def finish(self, succeeded):
+        self.succeeded = bool(succeeded)
+        self.endTime = time.time()
+        
+    def describe(self):
+        return {'folder': self.scriptFolder, 'app': self.appName, 'succeeded': self.succeeded,
+                'seconds': round((self.endTime or time.time()) - self.startTime, 1), 'ipas': self.ipas, 'links': self.links,
+                'commandSeconds': round(sum([result.wallTime for result in self.commandStatistics]), 1)}
+                
+def release(arguments, scriptFolder = None, connectionCache = None, report = None):
+    # scriptFolder is the folder of config.json inside the project, the working directory unless given
+    scriptFolder = os.path.abspath(scriptFolder or os.getcwd())
+    canContinue, buildConfig = loadConfig(scriptFolder)
     if not canContinue:
-        return
+        return False
 
-    thisFileFolderName = os.path.split(os.getcwd())[1]
-    projectPath = os.path.split(os.getcwd())[0]
+    thisFileFolderName = os.path.split(scriptFolder)[1]
+    projectPath = os.path.split(scriptFolder)[0]
     appName = os.path.split(projectPath)[1] # app name defaults to the folder name where app resides
     appName = appName.replace(' ', '') # trim the spaces
+    if report:
+        report.appName = appName
 
     print 'Export ipa of', appName
     
-    os.chdir('..')
-    
-    # generate ipas
     buildInfo = buildConfig.copy()
     buildInfo['BUILD_FOLDER'] = appName
     buildInfo['THIS_FILE_FOLDER'] = thisFileFolderName
+    buildInfo['PROJECT_PATH'] = projectPath
+    if arguments.dry_run:
+        printReleasePlan(IpaBuilderModel(buildInfo))
+        return True
+    
+    transferEngine = createTransferEngine(buildConfig, scriptFolder, connectionCache) if not arguments.build_only else None
+    # ship every ipa as soon as it is exported instead of waiting for all the profiles
+    pipelinesUploads = buildConfig.get('PIPELINE_UPLOADS', False) and transferEngine is not None
+    
+    # generate ipas
     builderModel = IpaBuilderModel(buildInfo)
-    builder = IpaBuilder(builderModel, True)
-    ipas = builder.run()
+    journal = ReleaseJournal(os.path.abspath(os.path.join(builderModel.outputFolder, 'releaseJournal.json')))
+    if not arguments.resume:
+        journal.start()
+    elif journal.resume():
+        print 'resume the release started at %s' % journal.stages['startTime']
+    else:
+        print 'the last release has finished. There is nothing to resume'
+        return False
+    if transferEngine:
+        transferEngine.setJournal(journal)
+    if pipelinesUploads:
+        # only after the checks above, which return without finishing the engine
+        try:
+            transferEngine.start()
+        except:
+            excInfo = sys.exc_info()
+            traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+            return False
+    # the commands of every release run in its own project folder with its own timeouts
+    releaseCommandRunner = CommandRunner(projectPath)
+    releaseCommandRunner.commandTimeout = buildConfig.get('COMMAND_TIMEOUT')
+    releaseCommandRunner.setOverallTimeout(buildConfig.get('RELEASE_TIMEOUT'))
+    releaseCommandRunner.showsOutput = buildConfig.get('SHOWS_COMMAND_OUTPUT', False)
+    builder = IpaBuilder(builderModel, True, buildConfig.get('BUILD_WORKERS', 1), releaseCommandRunner)
+    if report:
+        report.commandStatistics = releaseCommandRunner.statistics
+    if buildConfig.get('BUILD_CACHE', True):
+        builder.buildCache = BuildCache(os.path.join(builderModel.outputFolder, 'buildCache.json'))
+    builder.forcesRebuild = arguments.force_rebuild
+    builder.cleansBeforeArchive = buildConfig.get('CLEAN_BEFORE_ARCHIVE', True)
+    builder.journal = journal
+    artifactSizeLimit = buildConfig.get('ARTIFACT_SIZE_LIMIT_GB')
+    builder.artifactStore = ArtifactStore(builderModel.outputFolder, artifactSizeLimit * (1 << 30) if artifactSizeLimit else None,
+                                          buildConfig.get('ARTIFACTS_KEPT_PER_PROFILE'))
+    if builder.buildCache:
+        builder.artifactStore.onEvicted = lambda artifact: builder.buildCache.forget(artifact['archivePath'])
+    if pipelinesUploads:
+        builder.resultHandler = transferEngine.submit
+    try:
+        with tracer.span('build'):
+            ipas = builder.run()
+        if ipas and all(ipas):
+            # only after the build, so that nothing the release needs is removed
+            with tracer.span('evict'):
+                builder.artifactStore.evict()
+    finally:
+        if pipelinesUploads:
+            # wait for the uploads already queued even if a later profile failed
+            with tracer.span('transfer'):
+                uploadedLinks = transferEngine.finish()
+    if report:
+        report.ipas = [ipa for ipa in ipas or [] if ipa]
     if not ipas or not all(ipas):
-        return
+        return False
+    if arguments.build_only:
+        print 'built %s' % str(ipas)
+        return True
     
     zippedIpas = zip(ipas, builder.getProfiles())
     
-    os.chdir(thisFileFolderName)
-    
-    # upload to Google Drive
-    ipasToUploadToGoogleDrive = filteredIpas(zippedIpas, lambda ipaTuple: ipaTuple[1]['uploadsToGoogleDrive'])
-    print 'upload %s to %s of Google Drive' % (str(ipasToUploadToGoogleDrive), buildConfig['GOOGLE_API_CLIENT_INFO']['GOOGLE_DRIVE_PATH'])
-    GDriveLinkList = uploadToGoogleDrive(ipasToUploadToGoogleDrive, buildConfig['GOOGLE_API_CLIENT_INFO'])
-    if len(ipasToUploadToGoogleDrive) != len(GDriveLinkList) or not all(GDriveLinkList):
-        return
+    # the links in the mail are listed destination by destination
+    stageIpas = [filteredIpas(zippedIpas, lambda ipaTuple: stage.condition(ipaTuple[1])) for stage in transferEngine.stages]
+    if not pipelinesUploads:
+        for stage, ipasToUpload in zip(transferEngine.stages, stageIpas):
+            print 'upload %s to %s' % (str(ipasToUpload), stage.uploader.describe())
+        try:
+            transferEngine.start([(index, ipaTuple[1], ipaTuple[0]) for index, ipaTuple in enumerate(zippedIpas)])
+        except:
+            excInfo = sys.exc_info()
+            traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+            return False
+        with tracer.span('transfer'):
+            uploadedLinks = transferEngine.finish()
         
-    # upload to FTP server
-    ipasToUploadToFTPServer = filteredIpas(zippedIpas, lambda ipaTuple: ipaTuple[1]['uploadsToFTPServer'])
-    print 'upload %s to %s of %s' % (str(ipasToUploadToFTPServer), buildConfig['FTP_SERVER_BUILD_DIRECTORY'], buildConfig['FTP_SERVER_URL'])
-    FTPLinkList = uploadToFTPServer(ipasToUploadToFTPServer, buildConfig)
-    if len(ipasToUploadToFTPServer) != len(FTPLinkList):
-        return
+    if report:
+        report.links = uploadedLinks
+    zippedLinks = []
+    for stage, ipasToUpload in zip(transferEngine.stages, stageIpas):
+        links = uploadedLinks.get(stage.name)
+        if links is None or len(ipasToUpload) != len(links) or not all(links):
+            return False
+        zippedLinks += zip(ipasToUpload, links)
     
     # find description for the link
-    zippedGDriveIpaList = zip(ipasToUploadToGoogleDrive, GDriveLinkList)
-    zippedFTPIpaList = zip(ipasToUploadToFTPServer, FTPLinkList)
     ipaDict = dict(zippedIpas)
-    linkDescriptions = [(ipaTuple[1], ipaDict[ipaTuple[0]]['versionDescription']) for ipaTuple in zippedGDriveIpaList + zippedFTPIpaList]
+    linkDescriptions = [(ipaTuple[1], ipaDict[ipaTuple[0]]['versionDescription']) for ipaTuple in zippedLinks]
     
     # send the notification mail
-    if GDriveLinkList or FTPLinkList:
+    releasedRevision = None
+    if zippedLinks:
         mailTransferInfo = buildConfig['MAIL_TRANSFER_INFO']
         print 'send notification mail to %s' % str(mailTransferInfo['toUsers'])
         mailTitle = mailTransferInfo['titleTemplate'].format(**buildConfig)
-        bodyEditor = MailBodyEditor(mailTransferInfo['bodyFile'])
+        bodyEditor = MailBodyEditor(os.path.join(scriptFolder, mailTransferInfo['bodyFile']))
         keywordDict = buildConfig.copy()
-        keywordDict['DOWNLOAD_LINKS'] = generateHTMLHyperlinkListItems(GDriveLinkList + FTPLinkList, dict(linkDescriptions))
+        keywordDict['DOWNLOAD_LINKS'] = generateHTMLHyperlinkListItems([ipaTuple[1] for ipaTuple in zippedLinks], dict(linkDescriptions))
+        with tracer.span('checksumManifest'):
+            manifest = generateChecksumManifest([ipaTuple[0] for ipaTuple in zippedIpas if ipaTuple[0]], zippedLinks)
+        keywordDict['CHECKSUM_MANIFEST'] = generateHTMLChecksumManifest(manifest)
+        if 'RELEASE_NOTES' in compileMailTemplate(bodyEditor.fileData).fieldNames:
+            releaseNotes = None
+            if builder.versionControl.name == 'svn':
+                svnLogCache = SvnLogCache(os.path.join(builderModel.outputFolder, 'svnLogCache.json'), generateSvnAuthOptions(buildConfig), releaseCommandRunner)
+                with tracer.span('releaseNotes'):
+                    releaseNotes, releasedRevision = generateReleaseNotes(svnLogCache, mailTransferInfo.get('bugCodeURLs', None), buildConfig.get('RELEASE_NOTES_LIMIT', 100))
+                if releaseNotes is None:
+                    print 'release notes cannot be generated from svn log'
+            else:
+                print 'release notes are only generated from svn log'
+            # the field is filled either way, so that the template renders
+            keywordDict['RELEASE_NOTES'] = releaseNotes or ''
         bodyEditor.replaceKeywords(keywordDict)
         bodyEditor.linkifyBugCodes(mailTransferInfo.get('bugCodeURLs', None))
-        sendNotificationMail(mailTitle, bodyEditor.fileData, mailTransferInfo)
+        SMTPPool = connectionCache.getSMTPPool(mailTransferInfo) if connectionCache else None
+        mailSent = sendNotificationMail(mailTitle, bodyEditor.fileData, mailTransferInfo, os.path.join(builderModel.outputFolder, 'mailOutbox.json'), SMTPPool)
         bodyEditor.discard()
+        if not mailSent:
+            return False
+    journal.markDone('finished')
+    if releasedRevision:
+        # the notes of the next release start after this one
+        svnLogCache.markReleased(releasedRevision)
+    return True
+
+class ConnectionCache(object):
+    # the uploaders and the mail connections that a daemon keeps open from one release to the next
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idleUploaders = {}
+        self.SMTPPools = {}
+        
+    def acquireUploader(self, key):
+        with self.lock:
+            uploaders = self.idleUploaders.get(key)
+            uploader = uploaders.pop() if uploaders else None
+        if uploader:
+            uploader.ping()
+        return uploader
+        
+    def releaseUploader(self, key, uploader):
+        with self.lock:
+            self.idleUploaders.setdefault(key, []).append(uploader)
+            
+    def getSMTPPool(self, transferInfo):
+        key = json.dumps([transferInfo['SMTPServer'], transferInfo['SMTPUser'], transferInfo['SMTPPassword']])
+        with self.lock:
+            if key not in self.SMTPPools:
+                self.SMTPPools[key] = SMTPConnectionPool(transferInfo)
+            return self.SMTPPools[key]
+            
+    def close(self):
+        with self.lock:
+            uploaders = sum(self.idleUploaders.values(), [])
+            SMTPPools = self.SMTPPools.values()
+            self.idleUploaders = {}
+            self.SMTPPools = {}
+        for uploader in uploaders:
+            uploader.close()
+        for SMTPPool in SMTPPools:
+            SMTPPool.close()
+            
+class ReleaseJob(object):
+    def __init__(self, jobID, scriptFolder, argv):
+        self.jobID = jobID
+        self.scriptFolder = scriptFolder
+        self.argv = argv
+        # queued, running, succeeded or failed
+        self.state = 'queued'
+        self.submitTime = time.time()
+        self.startTime = None
+        self.endTime = None
+        self.report = None
+        
+    def describe(self):
+        return {'id': self.jobID, 'folder': self.scriptFolder, 'arguments': self.argv, 'state': self.state,
+                'submitTime': self.submitTime, 'startTime': self.startTime, 'endTime': self.endTime,
+                'report': self.report.describe() if self.report else None}
+                
+class ReleaseDaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # POST /jobs queues a release, GET /jobs lists the releases and GET /jobs/<id> describes one
+    def do_GET(self):
+        daemon = self.server.releaseDaemon
+        if '/jobs' == self.path:
+            self.sendJSON(200, [job.describe() for job in daemon.listJobs()])
+            return
+        match = re.match(r'^/jobs/(\d+)$', self.path)
+        job = daemon.getJob(int(match.group(1))) if match else None
+        if job:
+            self.sendJSON(200, job.describe())
+        else:
+            self.sendJSON(404, {'error': 'no such job'})
+            
+    def do_POST(self):
+        if '/jobs' != self.path:
+            self.sendJSON(404, {'error': 'no such resource'})
+            return
+        # a web page can post a simple request to the daemon, but not one of JSON without a preflight, which is never answered
+        if self.headers.getheader('Origin') is not None or (self.headers.getheader('Content-Type') or '').split(';')[0].strip() != 'application/json':
+            self.sendJSON(403, {'error': 'only JSON requests from outside a browser are accepted'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length') or 0)))
+            job = self.server.releaseDaemon.submit(request['folder'], request.get('arguments', []))
+        except (ValueError, KeyError, TypeError) as error:
+            self.sendJSON(400, {'error': str(error) or type(error).__name__})
+            return
+        self.sendJSON(202, job.describe())
+        
+    def sendJSON(self, status, data):
+        body = json.dumps(data, indent = 1, sort_keys = True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, format, *args):
+        pass
+        
+class ReleaseDaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+class ReleaseDaemon(object):
+    # releases the projects submitted to it with a pool of workers; the uploaders, the mail connections,
+    # the parsed configs and the file digests stay in memory from one release to the next
+    def __init__(self, port, workers = 1):
+        self.port = port
+        self.workers = max(workers, 1)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.projectLocks = {}
+        self.connectionCache = ConnectionCache()
+        
+    def submit(self, scriptFolder, argv):
+        scriptFolder = os.path.abspath(scriptFolder)
+        if not os.path.isfile(os.path.join(scriptFolder, 'config.json')):
+            raise ValueError('%s has no config.json' % scriptFolder)
+        try:
+            arguments = parseArguments(argv)
+        except SystemExit:
+            raise ValueError('invalid arguments %s' % ' '.join(argv))
+        if arguments.daemon or arguments.submit or arguments.jobs or arguments.trace or arguments.projects or arguments.report:
+            raise ValueError('--daemon, --submit, --jobs, --trace, --projects and --report cannot be submitted')
+        with self.lock:
+            job = ReleaseJob(len(self.jobs) + 1, scriptFolder, argv)
+            self.jobs[job.jobID] = job
+        print 'job %d: queue the release of %s %s' % (job.jobID, scriptFolder, ' '.join(argv))
+        self.queue.put(job)
+        return job
+        
+    def getJob(self, jobID):
+        with self.lock:
+            return self.jobs.get(jobID)
+            
+    def listJobs(self):
+        with self.lock:
+            return self.jobs.values()
+            
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            with self.lock:
+                projectLock = self.projectLocks.setdefault(os.path.dirname(job.scriptFolder), threading.Lock())
+            # releases of the same project edit the same working copy, so they take turns
+            with projectLock:
+                self.runJob(job)
+                
+    def runJob(self, job):
+        job.state = 'running'
+        job.startTime = time.time()
+        job.report = ReleaseReport(job.scriptFolder)
+        print 'job %d: release %s' % (job.jobID, job.scriptFolder)
+        try:
+            succeeded = release(parseArguments(job.argv), job.scriptFolder, self.connectionCache, job.report)
+        except:
+            succeeded = False
+            excInfo = sys.exc_info()
+            traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+        job.report.finish(succeeded)
+        job.endTime = time.time()
+        job.state = 'succeeded' if succeeded else 'failed'
+        print 'job %d: %s in %.1fs' % (job.jobID, job.state, job.endTime - job.startTime)
+        
+    def serve(self):
+        threads = []
+        for index in xrange(self.workers):
+            thread = threading.Thread(target = self.work, name = 'release worker #%d' % (index + 1))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # only local clients may submit releases
+        server = ReleaseDaemonServer(('127.0.0.1', self.port), ReleaseDaemonRequestHandler)
+        server.releaseDaemon = self
+        print 'release daemon listens on 127.0.0.1:%d with %d workers' % (self.port, self.workers)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print 'stop the release daemon'
+        finally:
+            server.server_close()
+            for thread in threads:
+                self.queue.put(None)
+            self.connectionCache.close()
+            
+def findScriptFolder(path):
+    # path is a config.json, the folder of one, or a project root with exactly one such folder in it
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        return os.path.dirname(path) if 'config.json' == os.path.basename(path) else None
+    if os.path.isfile(os.path.join(path, 'config.json')):
+        return path
+    if not os.path.isdir(path):
+        return None
+    scriptFolders = [os.path.join(path, name) for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name, 'config.json'))]
+    return scriptFolders[0] if 1 == len(scriptFolders) else None
+    
+def releaseProjects(arguments, paths):
+    scriptFolders = []
+    for path in paths:
+        scriptFolder = findScriptFolder(path)
+        if not scriptFolder:
+            print 'cannot find the config.json of %s' % path
+            return False
+        if scriptFolder not in scriptFolders:
+            scriptFolders.append(scriptFolder)
+    print 'release %d apps, %s' % (len(scriptFolders), resourceScheduler.describe())
+    
+    # every app is released at once; the resource scheduler decides how much of it runs at a time
+    connectionCache = ConnectionCache()
+    reports = [ReleaseReport(scriptFolder) for scriptFolder in scriptFolders]
+    def releaseProject(report):
+        try:
+            with tracer.span('release', folder = report.scriptFolder):
+                succeeded = release(arguments, report.scriptFolder, connectionCache, report)
+        except:
+            succeeded = False
+            excInfo = sys.exc_info()
+            traceback.print_exception(excInfo[0], excInfo[1], excInfo[2], limit = 2, file = sys.stdout)
+        report.finish(succeeded)
+        return succeeded
+    try:
+        runInParallel(releaseProject, reports, len(reports), False)
+    finally:
+        connectionCache.close()
+        
+    printReleaseReports(reports)
+    if arguments.report:
+        saveJSONFile(arguments.report, [report.describe() for report in reports])
+    return all([report.succeeded for report in reports])
+    
+def printReleaseReports(reports):
+    print 'release report:'
+    for report in reports:
+        summary = report.describe()
+        print '%s %s in %.1fs (%.1fs in commands), %d ipas' % (summary['app'] or summary['folder'], 'succeeded' if summary['succeeded'] else 'failed',
+                                                               summary['seconds'], summary['commandSeconds'], len(summary['ipas']))
+        for destination, links in sorted(summary['links'].items()):
+            for link in links or []:
+                print '    %s: %s' % (destination, link)
+                
+def requestReleaseDaemon(daemonURL, path, data = None):
+    request = urllib2.Request(daemonURL + path, json.dumps(data) if data is not None else None, {'Content-Type': 'application/json'})
+    try:
+        return json.load(urllib2.urlopen(request, timeout = 30))
+    except urllib2.HTTPError as error:
+        print 'the release daemon refused the request: %s' % json.load(error).get('error')
+    except (urllib2.URLError, socket.error) as error:
+        print 'cannot reach the release daemon at %s (%s)' % (daemonURL, str(error))
+        
+def submitRelease(daemonURL, scriptFolder, argv):
+    job = requestReleaseDaemon(daemonURL, '/jobs', {'folder': scriptFolder, 'arguments': argv})
+    if job:
+        print 'queued job %d' % job['id']
+    return bool(job)
+        
+def listReleaseJobs(daemonURL):
+    jobs = requestReleaseDaemon(daemonURL, '/jobs')
+    for job in jobs or []:
+        print '%d %s %s %s' % (job['id'], job['state'], job['folder'], ' '.join(job['arguments']))
+    return jobs is not None
 
 if '__main__' == __name__:
-    main()
\ No newline at end of file
+    # a failed release exits with 1, so that scripts and CI can tell
+    sys.exit(0 if main() else 1)
\ No newline at end of file